@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Benchmark for git-serve.
+
+Generates a synthetic repo, serves it with git-serve.py, and drives the pages and
+a clone at the given concurrency levels. Prints throughput and latency percentiles
+per route and concurrency as json.
+
+Same arguments give the same repo, commit ids included, so runs can be compared.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import tempfile
+import platform
+import threading
+import http.client
+from subprocess import Popen, PIPE, DEVNULL, check_output, run
+from concurrent.futures import ThreadPoolExecutor
+
+GIT_SERVE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "git-serve.py")
+ROUTES = ("browse", "view", "history", "diff", "commit", "refs", "clone")
+
+
+def git(repo, *cmd):
+	return check_output(["git", "-C", repo] + list(cmd), universal_newlines=True)
+
+
+def generate(path, commits=200, files=500, depth=3, tags=10, large_blobs=1, large_size=4 << 20, seed=1):
+	"""create a repo at `path` with `files` text files in directories `depth` levels deep,
+	`commits` commits touching a few files each, `tags` annotated tags and `large_blobs` blobs of `large_size` bytes"""
+	rnd = random.Random(seed)
+	words = ["".join(rnd.choice("abcdefghijklmnopqrstuvwxyz_") for _ in range(rnd.randint(2, 10))) for _ in range(2000)]
+	authors = [(f"Author {i}", f"author{i}@example.com") for i in range(10)]
+
+	def line():
+		return "    " * rnd.randint(0, 3) + " ".join(rnd.choice(words) for _ in range(rnd.randint(1, 12))) + "\n"
+
+	fanout = max(2, round(files ** (1.0 / (depth + 1))))
+	paths = []
+	for i in range(files):
+		dirs = [f"d{(i // fanout ** (j + 1)) % fanout}" for j in range(depth)]
+		paths.append("/".join(dirs + [f"f{i}.{rnd.choice(('py', 'c', 'md', 'txt', 'js'))}"]))
+	contents = {p: [line() for _ in range(rnd.randint(10, 300))] for p in paths}
+
+	os.makedirs(path, exist_ok=True)
+	run(["git", "init", "-q", path], check=True)
+	proc = Popen(["git", "-C", path, "fast-import", "--quiet"], stdin=PIPE)
+	out = proc.stdin
+
+	def data(b):
+		out.write(b"data %d\n" % len(b))
+		out.write(b)
+		out.write(b"\n")
+
+	tag_every = max(commits // tags, 1) if tags else 0
+	timestamp = 1500000000
+	for n in range(commits):
+		name, email = authors[rnd.randrange(len(authors))]
+		timestamp += rnd.randint(600, 86400)
+		out.write(b"commit refs/heads/master\n")
+		out.write(b"mark :%d\n" % (n + 1))
+		out.write(f"author {name} <{email}> {timestamp} +0000\n".encode())
+		out.write(f"committer {name} <{email}> {timestamp} +0000\n".encode())
+		if n == 0:
+			data(b"initial import")
+			changed = paths
+		else:
+			changed = rnd.sample(paths, min(len(paths), rnd.randint(1, 5)))
+			data(f"change {n}: {' '.join(rnd.choice(words) for _ in range(5))}".encode())
+			out.write(b"from :%d\n" % n)
+			for p in changed:
+				lines = contents[p]
+				start = rnd.randrange(len(lines))
+				lines[start:start + rnd.randint(0, 5)] = [line() for _ in range(rnd.randint(0, 8))]
+				if not lines:
+					lines.append(line())
+		for p in changed:
+			out.write(f"M 644 inline {p}\n".encode())
+			data("".join(contents[p]).encode())
+		if n == 0:
+			for i in range(large_blobs):
+				out.write(f"M 644 inline large/blob{i}.bin\n".encode())
+				data(rnd.getrandbits(8 * large_size).to_bytes(large_size, "little"))
+		out.write(b"\n")
+		if tag_every and (n + 1) % tag_every == 0:
+			out.write(f"tag v{(n + 1) // tag_every}\nfrom :{n + 1}\n".encode())
+			out.write(f"tagger {name} <{email}> {timestamp} +0000\n".encode())
+			data(f"release {(n + 1) // tag_every}".encode())
+	out.close()
+	if proc.wait() != 0:
+		raise RuntimeError("git fast-import failed")
+	run(["git", "-C", path, "checkout", "-q", "-f", "master"], check=True)
+
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+
+def start_server(repo, port, server, args=()):
+	"""run git-serve in `repo`, returns the process once it accepts connections"""
+	proc = Popen([sys.executable, server, str(port)] + list(args), cwd=repo, stdout=DEVNULL, stderr=DEVNULL)
+	deadline = time.monotonic() + 30
+	while time.monotonic() < deadline:
+		if proc.poll() is not None:
+			raise RuntimeError("git-serve exited with code %d" % proc.returncode)
+		try:
+			socket.create_connection(("127.0.0.1", port), timeout=1).close()
+			return proc
+		except OSError:
+			time.sleep(0.1)
+	proc.kill()
+	raise RuntimeError("git-serve did not start")
+
+
+def route_urls(repo):
+	"""urls to request for each route"""
+	files = git(repo, "ls-tree", "-r", "--name-only", "HEAD").split()
+	dirs = sorted({os.path.dirname(f) for f in files if "/" in f})
+	commits = git(repo, "rev-list", "--max-count=500", "--no-merges", "HEAD").split()
+	with_parent = commits[:-1]
+	return {
+		"browse": ["/browse/"] + [f"/browse/{d}/" for d in dirs],
+		"view": [f"/view/{f}" for f in files],
+		"history": ["/history/"] + [f"/history/{f}" for f in files],
+		"diff": [f"/diff/?ref={c}~1..{c}" for c in with_parent] or ["/diff/"],
+		"commit": [f"/commit/{c}/" for c in commits],
+		"refs": ["/refs/"],
+	}
+
+
+def fetch(port, url):
+	"""GET `url`, returns the status code"""
+	conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+	try:
+		conn.request("GET", url, headers={"Accept-Encoding": "gzip"})
+		r = conn.getresponse()
+		r.read()
+		return r.status
+	finally:
+		conn.close()
+
+
+def clone(port, repo_name, target):
+	shutil.rmtree(target, ignore_errors=True)
+	p = run(["git", "clone", "-q", f"http://127.0.0.1:{port}/{repo_name}", target], stdout=DEVNULL, stderr=DEVNULL)
+	shutil.rmtree(target, ignore_errors=True)
+	return 200 if p.returncode == 0 else 500
+
+
+def percentile(values, p):
+	"""nearest rank percentile of sorted `values`"""
+	if not values:
+		return None
+	k = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+	return values[min(k, len(values) - 1)]
+
+
+def drive(jobs, concurrency):
+	"""run the `jobs` callables on `concurrency` threads. returns (latencies, errors, wall time)"""
+	latencies = []
+	errors = 0
+	lock = threading.Lock()
+
+	def timed(job):
+		nonlocal errors
+		start = time.perf_counter()
+		try:
+			status = job()
+		except Exception:
+			status = None
+		elapsed = time.perf_counter() - start
+		with lock:
+			latencies.append(elapsed)
+			if status not in (200, 304):
+				errors += 1
+
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		list(executor.map(timed, jobs))
+	return sorted(latencies), errors, time.perf_counter() - start
+
+
+def result(route, concurrency, latencies, errors, wall):
+	return {
+		'route': route,
+		'concurrency': concurrency,
+		'requests': len(latencies),
+		'errors': errors,
+		'throughput': round(len(latencies) / wall, 3) if wall else None,
+		'mean': round(sum(latencies) / len(latencies), 6) if latencies else None,
+		'p50': round(percentile(latencies, 50), 6) if latencies else None,
+		'p95': round(percentile(latencies, 95), 6) if latencies else None,
+		'p99': round(percentile(latencies, 99), 6) if latencies else None,
+	}
+
+
+def bench(repo, port, routes, concurrency, requests, clones, warmup, seed, workdir):
+	rnd = random.Random(seed)
+	urls = route_urls(repo)
+	results = []
+	for route in routes:
+		if route == "clone":
+			repo_name = os.path.basename(os.path.abspath(repo))
+			for c in concurrency:
+				targets = [os.path.join(workdir, f"clone-{c}-{i}") for i in range(clones)]
+				jobs = [lambda t=t: clone(port, repo_name, t) for t in targets]
+				results.append(result(route, c, *drive(jobs, c)))
+			continue
+		for url in urls[route][:warmup]:
+			fetch(port, url)
+		for c in concurrency:
+			picks = [rnd.choice(urls[route]) for _ in range(requests)]
+			jobs = [lambda u=u: fetch(port, u) for u in picks]
+			results.append(result(route, c, *drive(jobs, c)))
+	return results
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Benchmark git-serve on a synthetic repo')
+	parser.add_argument('--repo', default=None,
+		               help='repo to benchmark. generated in a temp dir if missing (default: a temp dir)')
+	parser.add_argument('--commits', type=int, default=200, help='commits of the generated repo (default: 200)')
+	parser.add_argument('--files', type=int, default=500, help='files of the generated repo (default: 500)')
+	parser.add_argument('--depth', type=int, default=3, help='directory depth of the generated repo (default: 3)')
+	parser.add_argument('--tags', type=int, default=10, help='tags of the generated repo (default: 10)')
+	parser.add_argument('--large-blobs', dest='large_blobs', type=int, default=1,
+		               help='big binary files of the generated repo (default: 1)')
+	parser.add_argument('--large-size', dest='large_size', type=int, default=4,
+		               help='size of the big files, in MB (default: 4)')
+	parser.add_argument('--seed', type=int, default=1, help='random seed for the repo and the requests (default: 1)')
+	parser.add_argument('--routes', default=",".join(ROUTES),
+		               help=f'comma separated routes to drive (default: {",".join(ROUTES)})')
+	parser.add_argument('--concurrency', default="1,4,16",
+		               help='comma separated numbers of parallel clients (default: 1,4,16)')
+	parser.add_argument('--requests', type=int, default=200,
+		               help='requests per route and concurrency level (default: 200)')
+	parser.add_argument('--clones', type=int, default=4, help='clones per concurrency level (default: 4)')
+	parser.add_argument('--warmup', type=int, default=20,
+		               help='urls of each route requested once before measuring (default: 20)')
+	parser.add_argument('--server', default=GIT_SERVE, help='git-serve script to run (default: the one in this repo)')
+	parser.add_argument('--server-args', dest='server_args', default="",
+		               help='extra arguments for git-serve, e.g. "--workers 8"')
+	parser.add_argument('--output', default=None, help='write the results to this file (default: stdout)')
+	parser.add_argument('--keep', action='store_true', default=False,
+		               help='keep the generated repo and the caches')
+	args = parser.parse_args()
+
+	routes = [r for r in args.routes.split(",") if r]
+	for r in routes:
+		if not r in ROUTES:
+			parser.error(f"unknown route {r}")
+	concurrency = [int(c) for c in args.concurrency.split(",") if c]
+
+	workdir = tempfile.mkdtemp(prefix="git-serve-bench-")
+	repo = args.repo or os.path.join(workdir, "repo")
+	params = {
+		'commits': args.commits, 'files': args.files, 'depth': args.depth, 'tags': args.tags,
+		'large_blobs': args.large_blobs, 'large_size': args.large_size << 20, 'seed': args.seed,
+	}
+	server = None
+	try:
+		if not os.path.isdir(os.path.join(repo, ".git")):
+			start = time.perf_counter()
+			generate(repo, **params)
+			print(f"generated {repo} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+		port = free_port()
+		server_args = ["--cache-dir", os.path.join(workdir, "cache")] + args.server_args.split()
+		server = start_server(repo, port, args.server, server_args)
+		results = bench(repo, port, routes, concurrency, args.requests, args.clones, args.warmup, args.seed, workdir)
+
+		report = {
+			'repo': dict(params, path=repo, head=git(repo, "rev-parse", "HEAD").strip()),
+			'server_args': server_args[2:],
+			'requests': args.requests,
+			'clones': args.clones,
+			'warmup': args.warmup,
+			'python': platform.python_version(),
+			'git': git(repo, "--version").strip(),
+			'platform': platform.platform(),
+			'cpus': os.cpu_count(),
+			'results': results,
+		}
+		text = json.dumps(report, indent=2)
+		if args.output:
+			with open(args.output, "w") as f:
+				f.write(text + "\n")
+		else:
+			print(text)
+	finally:
+		if not server is None:
+			server.terminate()
+			server.wait()
+		if not args.keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+		else:
+			print(f"kept {workdir}", file=sys.stderr)
@@ -2,20 +2,41 @@
 # -*- coding: utf-8 -*-
 
 from http.server import HTTPServer, CGIHTTPRequestHandler
-from urllib.parse import parse_qs
+from http.client import parse_headers
+from http import HTTPStatus
+from http.cookies import SimpleCookie, CookieError
+from email.utils import formatdate
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from urllib.parse import parse_qs, urlencode, quote, unquote
 #import cgitb; cgitb.enable()  ## This line enables CGI error reporting
 import os
 import sys
 import codecs
-from subprocess import check_output, CalledProcessError
+from subprocess import check_output, CalledProcessError, Popen, PIPE, DEVNULL
 import re
 import cgi
+import html
 import hashlib
 import tempfile
+import shutil
 import atexit
 import traceback
 import logging
+import threading
+import asyncio
+import socket
+import io
+import time
+import random
+import bisect
+import json
+import zlib
+import gzip
+import mimetypes
+from collections import OrderedDict, namedtuple, defaultdict
 from functools import partial
+from itertools import chain, islice
+from array import array
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +57,16 @@ try:
 except ImportError:
 	markdown = None
 
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
 try:
 	from pygments import highlight
 	from pygments.lexers import guess_lexer, get_lexer_for_filename
@@ -44,64 +75,530 @@ except ImportError:
 	highlight = None
 
 
+class Metrics(object):
+	""" Counters, gauges and histograms, rendered in the Prometheus text format.
+	Series are keyed by metric name and a tuple of (label, value) pairs """
+	buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.series = {}
+		self.meta = OrderedDict()
+
+	def describe(self, name, mtype, text):
+		self.meta[name] = (mtype, text)
+		self.series.setdefault(name, {})
+
+	def inc(self, name, labels=(), value=1):
+		"""add `value` to counter or gauge `name`"""
+		with self.lock:
+			series = self.series[name]
+			series[labels] = series.get(labels, 0) + value
+
+	def observe(self, name, labels, value):
+		"""add `value` to histogram `name`"""
+		i = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			series = self.series[name]
+			h = series.get(labels)
+			if h is None:
+				# count per bucket, +Inf bucket, sum, count
+				h = series[labels] = [0] * (len(self.buckets) + 3)
+			h[i] += 1
+			h[-2] += value
+			h[-1] += 1
+
+	def timer(self, name, labels=()):
+		"""context manager observing the time spent in it"""
+		return _MetricsTimer(self, name, labels)
+
+	@staticmethod
+	def _labels(labels, extra=()):
+		labels = tuple(labels) + tuple(extra)
+		if not labels:
+			return ""
+		return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels) + "}"
+
+	def render(self):
+		with self.lock:
+			series = {name: dict((labels, list(v) if isinstance(v, list) else v) for labels, v in values.items()) for name, values in self.series.items()}
+		out = []
+		for name, (mtype, text) in self.meta.items():
+			out.append(f"# HELP {name} {text}")
+			out.append(f"# TYPE {name} {mtype}")
+			for labels, value in sorted(series[name].items()):
+				if mtype != "histogram":
+					out.append(f"{name}{self._labels(labels)} {value}")
+					continue
+				total = 0
+				for le, n in zip(self.buckets + ("+Inf",), value):
+					total += n
+					out.append(f"{name}_bucket{self._labels(labels, [('le', le)])} {total}")
+				out.append(f"{name}_sum{self._labels(labels)} {value[-2]}")
+				out.append(f"{name}_count{self._labels(labels)} {value[-1]}")
+		return "\n".join(out) + "\n"
+
+
+class _MetricsTimer(object):
+	def __init__(self, metrics, name, labels):
+		self.metrics, self.name, self.labels = metrics, name, labels
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+
+	def __exit__(self, *exc):
+		self.metrics.observe(self.name, self.labels, time.perf_counter() - self.start)
+
+
+metrics = Metrics()
+metrics.describe("git_serve_requests_total", "counter", "HTTP requests served, by route and status code")
+metrics.describe("git_serve_request_duration_seconds", "histogram", "Time to serve HTTP requests, response sending included, by route")
+metrics.describe("git_serve_requests_in_flight", "gauge", "HTTP requests being served")
+metrics.describe("git_serve_step_duration_seconds", "histogram", "Time spent highlighting, rendering markdown and sending responses")
+metrics.describe("git_serve_git_duration_seconds", "histogram", "Time spent in git, by subcommand. cat-file counts queries to the cat-file workers")
+metrics.describe("git_serve_cache_requests_total", "counter", "Cache lookups, by cache and result")
+metrics.describe("git_serve_upload_pack_bytes_total", "counter", "Bytes sent to clones and fetches, by whether they came from the pack cache")
+metrics.describe("git_serve_cat_file_workers_total", "counter", "cat-file workers taken from the pool, by event: reused, spawned or restarted after dying")
+metrics.describe("git_serve_cat_file_workers_idle", "gauge", "cat-file workers waiting in the pools")
+
+
+class GITCatFile:
+	"""a long running `git cat-file --batch` (or `--batch-check`) process"""
+	def __init__(self, git_args=(), check=False):
+		self.check = check
+		cmd = ['git'] + list(git_args) + ['cat-file', '--batch-check' if check else '--batch']
+		self.proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+
+	def alive(self):
+		return self.proc.poll() is None
+
+	def header(self, name):
+		"""asks for object `name`, returns (sha, type, size) or None if missing.
+		`--batch` workers must then read `size` bytes of content plus a newline"""
+		if "\n" in name:
+			return None
+		self.proc.stdin.write(name.encode("utf-8") + b"\n")
+		self.proc.stdin.flush()
+		header = self.proc.stdout.readline()
+		if header == b"":
+			raise BrokenPipeError("git cat-file died")
+		header = header.decode("utf-8").split()
+		if len(header) != 3 or header[-1] in ("missing", "ambiguous"):
+			return None
+		return header[0], header[1], int(header[2])
+
+	def query(self, name):
+		"""returns (sha, type, size, data) for object `name`, or None if missing.
+		`data` is None for `--batch-check` workers"""
+		r = self.header(name)
+		if r is None:
+			return None
+		sha, otype, size = r
+		data = None
+		if not self.check:
+			data = self.proc.stdout.read(size + 1)[:-1]
+			if len(data) != size:
+				raise BrokenPipeError("git cat-file died")
+		return sha, otype, size, data
+
+	def close(self):
+		try:
+			self.proc.stdin.close()
+		except OSError:
+			pass
+		if self.proc.poll() is None:
+			self.proc.kill()
+		self.proc.wait()
+
+
+class GITCatFilePool:
+	"""pool of `GITCatFile` workers, reused across requests"""
+	def __init__(self, git_args=(), size=4):
+		self.git_args = list(git_args)
+		self.size = size
+		self.idle = {True: [], False: []}
+		self.lock = threading.Lock()
+
+	def _acquire(self, check):
+		with self.lock:
+			while self.idle[check]:
+				worker = self.idle[check].pop()
+				metrics.inc("git_serve_cat_file_workers_idle", (), -1)
+				if worker.alive():
+					metrics.inc("git_serve_cat_file_workers_total", (("event", "reused"),))
+					return worker
+				worker.close()
+				metrics.inc("git_serve_cat_file_workers_total", (("event", "restarted"),))
+		metrics.inc("git_serve_cat_file_workers_total", (("event", "spawned"),))
+		return GITCatFile(self.git_args, check)
+
+	def _release(self, worker):
+		with self.lock:
+			if worker.alive() and len(self.idle[worker.check]) < self.size:
+				self.idle[worker.check].append(worker)
+				metrics.inc("git_serve_cat_file_workers_idle", (), 1)
+				return
+		worker.close()
+
+	def query(self, name, check=False):
+		with metrics.timer("git_serve_git_duration_seconds", (("command", "cat-file"),)):
+			return self._query(name, check)
+
+	def _query(self, name, check):
+		for attempt in (0, 1):
+			worker = self._acquire(check)
+			try:
+				r = worker.query(name)
+			except (BrokenPipeError, ValueError, OSError):
+				# dead worker, restart it once
+				worker.close()
+				metrics.inc("git_serve_cat_file_workers_total", (("event", "restarted"),))
+				if attempt:
+					raise
+				continue
+			self._release(worker)
+			return r
+
+	def stream(self, name, chunk_size=1 << 16):
+		"""yields the content of object `name` in chunks of bytes.
+		the worker goes back to the pool only if the object was read to the end"""
+		worker = self._acquire(False)
+		done = False
+		try:
+			try:
+				r = worker.header(name)
+			except (BrokenPipeError, ValueError, OSError):
+				worker.close()
+				metrics.inc("git_serve_cat_file_workers_total", (("event", "restarted"),))
+				worker = self._acquire(False)
+				r = worker.header(name)
+			if r is None:
+				done = True
+				return
+			remaining = r[2]
+			while remaining > 0:
+				chunk = worker.proc.stdout.read(min(chunk_size, remaining))
+				if not chunk:
+					raise BrokenPipeError("git cat-file died")
+				remaining -= len(chunk)
+				yield chunk
+			worker.proc.stdout.read(1)
+			done = True
+		finally:
+			if done:
+				self._release(worker)
+			else:
+				worker.close()
+
+	def close(self):
+		with self.lock:
+			workers = self.idle[True] + self.idle[False]
+			self.idle = {True: [], False: []}
+			metrics.inc("git_serve_cat_file_workers_idle", (), -len(workers))
+		for worker in workers:
+			worker.close()
+
+
+TreeEntry = namedtuple("TreeEntry", "mode type sha size name")
+# `peeled` is the object an annotated tag points to, `sha` for other refs
+Ref = namedtuple("Ref", "name sha type peeled")
+
+
 class GIT:
 	"""stupid git cli interface"""
-	current_ref = "HEAD"
+	git_args = []
+	pool_size = 4
+	_pool = None
+	_pool_lock = threading.Lock()
+	_git_dirs = None
+	_refs = None
+	_refs_lock = threading.Lock()
+	_ref_dirs = None
+	_refs_stamp = None
+	trees_cache_size = 4096
+	_trees = OrderedDict()
+	_trees_lock = threading.Lock()
+	_commit_locks = defaultdict(threading.Lock)
+	_commit_locks_lock = threading.Lock()
+
+	@classmethod
+	def for_repo(cls, path):
+		"""a GIT class working on the repository at `path`, with its own pool and caches"""
+		return type(cls.__name__, (cls,), {
+			'git_args': cls.git_args + ["-C", path],
+			'_pool': None,
+			'_pool_lock': threading.Lock(),
+			'_git_dirs': None,
+			'_refs': None,
+			'_refs_lock': threading.Lock(),
+			'_ref_dirs': None,
+			'_refs_stamp': None,
+			'_trees': OrderedDict(),
+			'_trees_lock': threading.Lock(),
+			'_commit_locks': defaultdict(threading.Lock),
+			'_commit_locks_lock': threading.Lock(),
+		})
+
+	@classmethod
+	def close(cls):
+		"""stop the cat-file workers"""
+		with cls._pool_lock:
+			if not cls._pool is None:
+				cls._pool.close()
+				cls._pool = None
 
 	@classmethod
-	def _do(cls, *cmd):
-		cmd = ['git']+list(cmd)
-		r = check_output(cmd,universal_newlines=True)
+	def _do(cls, *cmd, input=None, stderr=None):
+		with metrics.timer("git_serve_git_duration_seconds", (("command", cmd[0]),)):
+			cmd = ['git']+cls.git_args+list(cmd)
+			r = check_output(cmd,universal_newlines=True,input=input,stderr=stderr)
 		return r
-		
+
+	@classmethod
+	def pool(cls):
+		"""the `git cat-file` worker pool, started on first use"""
+		if cls._pool is None:
+			with cls._pool_lock:
+				if cls._pool is None:
+					cls._pool = GITCatFilePool(cls.git_args, cls.pool_size)
+		return cls._pool
+
+	@classmethod
+	def resolve(cls, name):
+		"""returns (sha, type, size) of object `name`, or None"""
+		r = cls.pool().query(name, check=True)
+		if r is None:
+			return None
+		return r[:3]
+
+	@classmethod
+	def cat(cls, name, otype=None):
+		"""returns (sha, type, data) of object `name`.
+		raises CalledProcessError if object is missing or is not of type `otype`"""
+		r = cls.pool().query(name)
+		if r is None or (otype is not None and r[1] != otype):
+			raise CalledProcessError(128, ['git', 'cat-file', otype or '-p', name])
+		return r[0], r[1], r[3]
+
+	@classmethod
+	def cat_stream(cls, name):
+		"""yields the content of object `name` in chunks of bytes, nothing if it is missing"""
+		return cls.pool().stream(name)
+
+	@classmethod
+	def stream(cls, *cmd, chunk_size=1 << 16):
+		"""run git, yields its output in chunks of bytes as soon as they are produced"""
+		labels = (("command", cmd[0]),)
+		start = time.perf_counter()
+		cmd = ['git']+cls.git_args+list(cmd)
+		proc = Popen(cmd, stdout=PIPE)
+		try:
+			while True:
+				chunk = proc.stdout.read1(chunk_size)
+				if not chunk:
+					break
+				yield chunk
+		finally:
+			proc.stdout.close()
+			if proc.poll() is None:
+				proc.kill()
+			returncode = proc.wait()
+			metrics.observe("git_serve_git_duration_seconds", labels, time.perf_counter() - start)
+		if returncode != 0:
+			raise CalledProcessError(returncode, cmd)
+
 	@classmethod
 	def rev_parse(cls,*args):
 		return cls._do("rev-parse", *args)
 
 	@classmethod
-	def branch(cls, *args):
-		r = cls._do("branch", *args).strip()
-		return [b.strip("\n\r *") for b in r.split("\n") if b.strip("\n\r *") != ""]
+	def rev(cls, ref):
+		"""full sha of commit `ref`. raises CalledProcessError if `ref` is not a commit"""
+		r = cls.resolve(f"{ref}^{{commit}}")
+		if r is None:
+			raise CalledProcessError(128, ['git', 'rev-parse', ref])
+		return r[0]
+
+	@classmethod
+	def is_sha(cls, ref):
+		"""True if `ref` is a full object name, optionally followed by ~n or ^n"""
+		return re.match(r'^[0-9a-f]{40}([0-9a-f]{24})?([~^][0-9]*)*$', ref) is not None
+
+	@classmethod
+	def git_dirs(cls):
+		"""(git dir, common git dir) of the repo"""
+		if cls._git_dirs is None:
+			r = cls._do("rev-parse", "--path-format=absolute", "--git-dir", "--git-common-dir")
+			cls._git_dirs = tuple(r.strip().split("\n"))
+		return cls._git_dirs
+
+	@classmethod
+	def refs_stamp(cls):
+		"""a value that changes whenever a ref is updated, from the stat of HEAD, packed-refs and the directories
+		of loose refs: git replaces loose refs with a rename, which updates their directory"""
+		git_dir, common_dir = cls.git_dirs()
+		files = [os.path.join(git_dir, "HEAD"), os.path.join(common_dir, "packed-refs")]
+		dirs = cls._ref_dirs
+		if not dirs is None:
+			stamp = stat_stamp(files + dirs)
+			if stamp == cls._refs_stamp:
+				return stamp
+		# something changed, look for new directories too
+		dirs = []
+		for root, subdirs, names in os.walk(os.path.join(common_dir, "refs")):
+			subdirs.sort()
+			dirs.append(root)
+		stamp = stat_stamp(files + dirs)
+		cls._ref_dirs, cls._refs_stamp = dirs, stamp
+		return stamp
+
+	@classmethod
+	def is_ancestor(cls, ref1, ref2):
+		try:
+			cls._do("merge-base", "--is-ancestor", ref1, ref2)
+		except CalledProcessError:
+			return False
+		return True
+
+	@classmethod
+	def short(cls, ref):
+		"""abbreviate full object names, leave symbolic refs alone"""
+		if re.match(r'^[0-9a-f]{40,64}$', ref):
+			return ref[:7]
+		return ref
+
+	@classmethod
+	def refs(cls):
+		"""all the refs, as a dict of refname -> Ref. loaded with one `for-each-ref` and
+		kept until refs change on disk"""
+		stamp = cls.refs_stamp()
+		snapshot = cls._refs
+		if snapshot is None or snapshot[0] != stamp:
+			with cls._refs_lock:
+				snapshot = cls._refs
+				if snapshot is None or snapshot[0] != stamp:
+					refs = OrderedDict()
+					r = cls._do("for-each-ref", "--format=%(objectname) %(objecttype) %(*objectname) %(refname)")
+					for line in r.splitlines():
+						sha, otype, peeled, name = line.split(" ", 3)
+						refs[name] = Ref(name, sha, otype, peeled or sha)
+					snapshot = cls._refs = (stamp, refs)
+		return snapshot[1]
 
 	@classmethod
-	def branch_current(cls, *args):
-		r = cls._do("branch", *args).strip()
-		return ''.join(b.strip("\n\r *") for b in r.split("\n") if b.strip().startswith("*"))
+	def branch(cls):
+		return [name[11:] for name in cls.refs() if name.startswith("refs/heads/")]
 
 	@classmethod		
-	def tag(cls, *args):
-		r = cls._do("tag", *args).strip()
-		return [b.strip("\n\r *") for b in r.split("\n") if b.strip("\n\r *") != ""]
+	def tag(cls):
+		return [name[10:] for name in cls.refs() if name.startswith("refs/tags/")]
 
 	@classmethod
-	def files(cls, base=".", ref=None):
-		if base == "":
-			base = "."
-		ref = ref or cls.current_ref
-		files = cls._do("ls-tree", "--name-only", ref, base).strip()
-		dirs = cls._do("ls-tree", "-d","--name-only", ref, base).strip()
-
-		dirs = [b.strip("\n\r") for b in dirs.split("\n") if b.strip("\n\r") != ""]
-		if base != "":
-			dirset = set([base.strip("/")]+dirs)
+	def tree(cls, treeish):
+		"""entries of a tree, as TreeEntry tuples sorted by name. cached by tree id"""
+		r = cls.resolve(treeish)
+		if r is None or r[1] != "tree":
+			raise CalledProcessError(128, ['git', 'ls-tree', treeish])
+		sha = r[0]
+		with cls._trees_lock:
+			entries = cls._trees.get(sha)
+			if not entries is None:
+				cls._trees.move_to_end(sha)
+				return entries
+
+		entries = []
+		for line in nul_split(cls.stream("ls-tree", "-z", "--long", sha)):
+			info, name = line.split("\t", 1)
+			mode, otype, osha, size = info.split()
+			entries.append(TreeEntry(mode, otype, osha, -1 if size == "-" else int(size), name))
+		entries = tuple(entries)
+
+		with cls._trees_lock:
+			cls._trees[sha] = entries
+			while len(cls._trees) > cls.trees_cache_size:
+				cls._trees.popitem(last=False)
+		return entries
+
+	@classmethod
+	def write_tree(cls, tree, path, blob):
+		"""id of a new tree: `tree` (None for an empty one) with file `path` set to
+		blob `blob`, or removed if `blob` is None. only the trees along `path` are written.
+		None if the tree would be empty"""
+		name, _, rest = path.partition("/")
+		entries = {e.name: e for e in cls.tree(tree)} if tree else {}
+		if rest:
+			sub = entries.get(name)
+			sub = cls.write_tree(sub.sha if sub and sub.type == "tree" else None, rest, blob)
+			entry = TreeEntry("040000", "tree", sub, -1, name) if sub else None
 		else:
-			dirset = set(dirs)
-		
-		files = [b.strip("\n\r") for b in files.split("\n") if b not in dirset and b.strip("\n\r") != ""]
-		
-		return sorted(dirs), sorted(files)
+			entry = TreeEntry("100644", "blob", blob, -1, name) if blob else None
+		if entry is None:
+			entries.pop(name, None)
+		else:
+			entries[name] = entry
+		if not entries:
+			# drop directories left empty, never create them
+			return None
+		data = "".join(f"{e.mode} {e.type} {e.sha}\t{e.name}\0" for e in entries.values())
+		return cls._do("mktree", "-z", input=data).strip()
+
+	@classmethod
+	def commit_file(cls, ref, path, text, message, retries=5):
+		"""commit `text` as file `path` (remove it if `text` is None) on branch `ref`
+		without a work tree. commits to the same branch are serialized in this process;
+		the branch is moved with a compare-and-swap update-ref, and if another process moved it
+		in the meantime the commit is rebuilt on the new tip. returns the new commit id"""
+		blob = None
+		if not text is None:
+			blob = cls._do("hash-object", "-w", "--stdin", input=text).strip()
+		with cls._commit_locks_lock:
+			lock = cls._commit_locks[ref]
+		with lock:
+			for attempt in range(retries):
+				if attempt:
+					# back off, with jitter so that racing writers don't retry in step
+					time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+				tip = cls.resolve(f"refs/heads/{ref}^{{commit}}")
+				parent = ["-p", tip[0]] if tip else []
+				tree = cls.write_tree(f"{tip[0]}^{{tree}}" if tip else None, path, blob)
+				if tree is None:
+					tree = cls._do("mktree", input="").strip()
+				commit = cls._do("commit-tree", tree, *parent, "-m", message).strip()
+				try:
+					cls._do("update-ref", "-m", message, f"refs/heads/{ref}", commit, tip[0] if tip else "0" * 40, stderr=PIPE)
+				except CalledProcessError:
+					# lost the race, rebuild on top of the new tip
+					continue
+				return commit
+		raise CalledProcessError(1, ['git', 'update-ref', f"refs/heads/{ref}"], output=f"{ref} is being updated too often, try again")
+
+	@classmethod
+	def files(cls, base=".", ref=None):
+		"""entries of directory `base`, as two lists of TreeEntry: (dirs, files)"""
+		ref = ref or "HEAD"
+		base = base.strip("/")
+		prefix = base + "/" if base not in ("", ".") else ""
+		try:
+			entries = cls.tree(f"{ref}:{prefix}")
+		except CalledProcessError:
+			return [], []
+
+		dirs = [e for e in entries if e.type == "tree"]
+		files = [e for e in entries if e.type != "tree"]
+		return dirs, files
 
 	@classmethod
 	def show(cls, file, ref):
-		ref = ref or cls.current_ref
-		return cls._do("show", f"{ref}:{file}")
+		ref = ref or "HEAD"
+		sha, otype, data = cls.cat(f"{ref}:{file}", "blob")
+		return data.decode("utf-8", "replace")
 
 	@classmethod
-	def log(cls, file="", ref=None, n=40):
+	def log(cls, file="", ref=None, n=40, date="relative"):
 		if file == "":
 			file = "."
-		ref = ref or cls.current_ref
-		r = cls._do("log", '-'+str(n), '--pretty=format:%h|%x09|%an|%x09|%ad|%x09|%s|%x09|%ae|%x09|%d', '--date=relative', ref, "--", file)
+		ref = ref or "HEAD"
+		r = cls._do("log", '-'+str(n), '--pretty=format:%h|%x09|%an|%x09|%ad|%x09|%s|%x09|%ae|%x09|%d|%x09|%H', f'--date={date}', ref, "--", file)
 		r = r.strip(" \n\r")
 		if r == "":
 			return []
@@ -109,66 +606,1069 @@ class GIT:
 		return logs
 
 	@classmethod
-	def diff_tree(cls,ref=None):
-		ref = ref or cls.current_ref
-		r = cls._do("diff-tree", "--no-commit-id", "--name-status", "-r", ref).strip(" \n\r")
-		if r == "":
-			return []
-		r = [l.strip().split("\t") for l in r.split("\n")]
-		return r
+	def diff(cls, path="", ref1=None, ref2=None):
+		"""yields the diff in chunks of bytes"""
+		if path == "":
+			path = "."
+		ref1 = ref1 or "HEAD"
+		ref2 = ref2 or ref1+"~1"
+		return cls.stream("diff", "--no-renames", ref1, ref2, "--", path)
 
 	@classmethod
-	def diff(cls, path="", ref1=None, ref2=None):
+	def numstat(cls, path="", ref1=None, ref2=None):
+		"""[(added, deleted, path)] of the files in `diff`, in the same order.
+		added and deleted are None for binary files"""
 		if path == "":
 			path = "."
-		ref1 = ref1 or cls.current_ref
+		ref1 = ref1 or "HEAD"
 		ref2 = ref2 or ref1+"~1"
-		r = cls._do("diff", ref1, ref2, "--", path)
-		if r.strip() == "":
-			return None, None, None
-		
-		ref1 = cls._do("rev-parse","--short", ref1).strip()
-		ref2 = cls._do("rev-parse","--short", ref2).strip()
-		
-		return r, ref1, ref2
+		files = []
+		for item in cls._do("diff", "--numstat", "-z", "--no-renames", ref1, ref2, "--", path).split("\0"):
+			if item == "":
+				continue
+			added, deleted, name = item.split("\t", 2)
+			if added == "-":
+				files.append((None, None, name))
+			else:
+				files.append((int(added), int(deleted), name))
+		return files
 
+	@classmethod
+	def last_change(cls, ref, path):
+		"""id of the last commit changing `path` in the history of `ref`"""
+		return cls._do("rev-list", "-1", ref, "--", path).strip()
 
+	@classmethod
+	def diff_hunks(cls, blob1, blob2):
+		"""[(start1, count1, start2, count2)] of the hunks of the diff between two blobs, without context"""
+		hunks = []
+		for m in re.finditer(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@', cls._do("diff", "-U0", blob1, blob2), re.M):
+			a, b, c, d = m.groups()
+			hunks.append((int(a), 1 if b is None else int(b), int(c), 1 if d is None else int(d)))
+		return hunks
 
-class GITServePages(object):
-	""" Routing, controllers and template """
-	def __init__(self, options):
-		self.use_md = not markdown is None
-		self.use_pygments = not highlight is None
-		if self.use_md:
-			print("[#] markdown ", end=" ")
+	@classmethod
+	def empty_tree(cls):
+		"""id of the empty tree, to diff root commits against"""
+		return cls._do("hash-object", "-t", "tree", "--stdin", input="").strip()
+
+
+
+def stat_stamp(files):
+	"""hash of the stat of `files`, missing ones are skipped"""
+	h = hashlib.sha1()
+	for fname in files:
+		try:
+			st = os.stat(fname)
+		except OSError:
+			continue
+		h.update(f"{fname} {st.st_ino} {st.st_size} {st.st_mtime_ns}\n".encode("utf-8", "surrogateescape"))
+	return h.hexdigest()
+
+
+def is_binary(data):
+	"""git heuristic: binary files have a NUL in the first 8000 bytes"""
+	return b"\0" in data[:8000]
+
+
+def content_encodings():
+	"""supported content encodings, best first"""
+	encodings = []
+	if not brotli is None:
+		encodings.append("br")
+	if not zstandard is None:
+		encodings.append("zstd")
+	encodings.append("gzip")
+	return encodings
+
+
+def accepted_encodings(header):
+	"""supported encodings accepted by an Accept-Encoding `header`, best first"""
+	accepted = {}
+	for item in header.split(","):
+		name, _, params = item.strip().partition(";")
+		q = 1.0
+		m = re.search(r'q\s*=\s*([0-9.]+)', params)
+		if m:
+			try:
+				q = float(m.group(1))
+			except ValueError:
+				q = 0.0
+		accepted[name.strip().lower()] = q
+	return [e for e in content_encodings() if accepted.get(e, accepted.get("*", 0)) > 0]
+
+
+def compress(data, encoding):
+	if encoding == "br":
+		return brotli.compress(data)
+	if encoding == "zstd":
+		return zstandard.ZstdCompressor().compress(data)
+	return gzip.compress(data, 6, mtime=0)
+
+
+def gzip_stream(chunks):
+	"""gzip chunks of str or bytes, each one is flushed as soon as it's compressed"""
+	z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	try:
+		for chunk in chunks:
+			if isinstance(chunk, str):
+				chunk = chunk.encode("utf-8")
+			if chunk:
+				yield z.compress(chunk) + z.flush(zlib.Z_SYNC_FLUSH)
+		yield z.flush()
+	finally:
+		if hasattr(chunks, "close"):
+			chunks.close()
+
+
+def parse_range(header, size, max_ranges=16):
+	"""(start, end) byte ranges, end included, asked by a Range `header` for `size` bytes.
+	None if the header is invalid or asks for too many ranges, then it must be ignored.
+	an empty list if no range is satisfiable"""
+	unit, _, spec = header.partition("=")
+	if unit.strip().lower() != "bytes":
+		return None
+	ranges = []
+	items = [i.strip() for i in spec.split(",") if i.strip()]
+	if not items or len(items) > max_ranges:
+		return None
+	for item in items:
+		m = re.match(r'^([0-9]*)-([0-9]*)$', item)
+		if m is None or m.group(1) == m.group(2) == "":
+			return None
+		if m.group(1) == "":
+			# suffix range, the last n bytes
+			n = int(m.group(2))
+			if n > 0 and size > 0:
+				ranges.append((max(size - n, 0), size - 1))
+			continue
+		start = int(m.group(1))
+		end = int(m.group(2)) if m.group(2) else max(start, size - 1)
+		if end < start:
+			return None
+		if start < size:
+			ranges.append((start, min(end, size - 1)))
+	return ranges
+
+
+def byte_range(chunks, start, end, drain=0):
+	"""yields bytes `start` to `end` included of the chunks of bytes `chunks`, without copying them.
+	up to `drain` bytes after the range are read and dropped, to let `chunks` finish instead of closing it"""
+	pos = 0
+	try:
+		for chunk in chunks:
+			n = len(chunk)
+			if pos <= end and pos + n > start:
+				yield memoryview(chunk)[max(start - pos, 0):end + 1 - pos]
+			pos += n
+			if pos > end + drain:
+				break
+	finally:
+		if hasattr(chunks, "close"):
+			chunks.close()
+
+
+def file_chunks(f, chunk_size=1 << 16):
+	"""yields the content of file `f` in chunks of bytes, and closes it"""
+	with f:
+		yield from iter(partial(f.read, chunk_size), b"")
+
+
+def pkt_line(data):
+	"""git pkt-line framing"""
+	return b"%04x%s" % (len(data) + 4, data)
+
+
+def pkt_lines(data):
+	"""split git pkt-lines, yields their payload. flush and delimiter packets are skipped"""
+	pos = 0
+	while pos + 4 <= len(data):
+		size = int(data[pos:pos+4], 16)
+		if size < 4:
+			pos += 4
+			continue
+		yield data[pos+4:pos+size]
+		pos += size
+
+
+def nul_split(chunks):
+	"""split chunks of bytes at NULs, yields decoded strings"""
+	rest = b""
+	for chunk in chunks:
+		parts = (rest + chunk).split(b"\0")
+		rest = parts.pop()
+		for part in parts:
+			yield part.decode("utf-8", "surrogateescape")
+	if rest:
+		yield rest.decode("utf-8", "surrogateescape")
+
+
+def human_size(size):
+	"""'1.2 MB'"""
+	for unit in ("bytes", "KB", "MB", "GB"):
+		if size < 1024 or unit == "GB":
+			break
+		size /= 1024
+	return f"{size} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+
+
+def reltime(timestamp):
+	"""'3 days ago'"""
+	delta = max(int(time.time() - timestamp), 0)
+	for unit, seconds in (("year", 31536000), ("month", 2592000), ("week", 604800), ("day", 86400), ("hour", 3600), ("minute", 60)):
+		if delta >= seconds:
+			n = delta // seconds
+			return f"{n} {unit}{'s' if n > 1 else ''} ago"
+	return f"{delta} second{'s' if delta != 1 else ''} ago"
+
+
+def split_diff(chunks, keep, max_size=None):
+	"""yields (n, text) for the parts of a diff given as chunks of bytes that are about the files number `n` in `keep`.
+	text is None for the parts over `max_size` bytes, they are not buffered past it. stops reading after the last one"""
+	last = max(keep, default=-1)
+	n = -1
+	part = None
+	# start of the current line while it's too short to tell if it starts a file, None in the middle of a line
+	head = b""
+	for chunk in chunks:
+		pos = 0
+		while pos < len(chunk):
+			end = chunk.find(b"\n", pos) + 1 or len(chunk)
+			line = chunk[pos:end]
+			pos = end
+			if not head is None:
+				line = head + line
+				if len(line) < 11 and not line.endswith(b"\n"):
+					head = line
+					continue
+				if line.startswith(b"diff --git "):
+					if n in keep:
+						yield n, None if part is None else part.decode("utf-8", "replace")
+					n += 1
+					if n > last:
+						return
+					part = bytearray() if n in keep else None
+			head = b"" if line.endswith(b"\n") else None
+			if not part is None:
+				part += line
+				if not max_size is None and len(part) > max_size:
+					part = None
+	if head and not part is None:
+		part += head
+	if n in keep:
+		yield n, None if part is None else part.decode("utf-8", "replace")
+
+
+class BlameParser(object):
+	""" Parser of `git blame --incremental` output, fed as it arrives """
+	def __init__(self):
+		# commit id -> [author, author time, summary]
+		self.commits = {}
+		self.entry = None
+
+	def feed(self, text):
+		"""parse the whole lines of `text`, returns the entries completed by them
+		as [commit, line in the commit, line in the file, number of lines, path in the commit]"""
+		done = []
+		for line in text.split("\n"):
+			if line == "":
+				continue
+			if self.entry is None:
+				sha, orig, final, count = line.split(" ")[:4]
+				self.entry = [sha, int(orig), int(final), int(count), None]
+				self.commits.setdefault(sha, ["", 0, ""])
+				continue
+			key, _, value = line.partition(" ")
+			info = self.commits[self.entry[0]]
+			if key == "author":
+				info[0] = value
+			elif key == "author-time":
+				info[1] = int(value)
+			elif key == "summary":
+				info[2] = value
+			elif key == "filename":
+				self.entry[4] = value
+				done.append(self.entry)
+				self.entry = None
+		return done
+
+
+def derive_blame(blame, hunks, commit, info, path):
+	"""the blame of a file after `commit` changed it, from its `blame` before and the `hunks` of the change.
+	lines out of the hunks keep their blame, the others go to `commit`, described by `info`"""
+	lines = []
+	for sha, orig, final, count, fname in blame['entries']:
+		lines.extend((sha, orig + i, fname) for i in range(count))
+	new = []
+	pos = 0
+	for start1, count1, start2, count2 in hunks:
+		# a hunk removing nothing starts after line `start1`
+		end = start1 - 1 if count1 else start1
+		if end < pos or end > len(lines):
+			return None
+		new.extend(lines[pos:end])
+		if count2 and len(new) != start2 - 1:
+			return None
+		new.extend((commit, start2 + i, path) for i in range(count2))
+		pos = end + count1
+	new.extend(lines[pos:])
+
+	entries = []
+	for n, (sha, orig, fname) in enumerate(new, 1):
+		last = entries[-1] if entries else None
+		if not last is None and last[0] == sha and last[4] == fname and last[1] + last[3] == orig:
+			last[3] += 1
 		else:
-			print("[ ] markdown ", end=" ")
-		if self.use_pygments:
-			print("[#] pygments ", end=" ")
+			entries.append([sha, orig, n, 1, fname])
+	commits = {sha: blame['commits'][sha] for sha in set(e[0] for e in entries) if sha in blame['commits']}
+	commits[commit] = info
+	return {'commits': commits, 'entries': entries}
+
+
+def text_chunks(chunks):
+	"""decode chunks of utf-8 bytes, yields text split at line ends"""
+	decoder = codecs.getincrementaldecoder("utf-8")("replace")
+	rest = ""
+	for chunk in chunks:
+		text = rest + decoder.decode(chunk)
+		end = text.rfind("\n") + 1
+		rest = text[end:]
+		if end:
+			yield text[:end]
+	rest += decoder.decode(b"", final=True)
+	if rest:
+		yield rest
+
+
+class DiskCache(object):
+	""" Size bounded key/value store in a directory, evicts least recently used entries """
+	# age of the temporary files removed at startup, in seconds
+	tmp_max_age = 3600
+
+	def __init__(self, path, max_size, name="disk"):
+		self.path = path
+		self.max_size = max_size
+		self.lock = threading.Lock()
+		# labels of the lookup counters
+		self.hit = (("cache", name), ("result", "hit"))
+		self.miss = (("cache", name), ("result", "miss"))
+		os.makedirs(path, exist_ok=True)
+		files = []
+		for name in os.listdir(path):
+			fname = os.path.join(path, name)
+			try:
+				st = os.stat(fname)
+				if name.startswith(".tmp-"):
+					# left over by an interrupted write, unless another server is still writing it
+					if st.st_mtime < time.time() - self.tmp_max_age:
+						os.unlink(fname)
+					continue
+			except FileNotFoundError:
+				# evicted by another server sharing the directory
+				continue
+			files.append((st.st_mtime, name, st.st_size))
+		self.entries = OrderedDict((name, size) for mtime, name, size in sorted(files))
+		self.size = sum(self.entries.values())
+
+	def _name(self, key):
+		return hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+
+	def open(self, key):
+		"""open the entry for `key` for reading, returns None if it's not there"""
+		name = self._name(key)
+		with self.lock:
+			if name not in self.entries:
+				metrics.inc("git_serve_cache_requests_total", self.miss)
+				return None
+			self.entries.move_to_end(name)
+		metrics.inc("git_serve_cache_requests_total", self.hit)
+		try:
+			f = open(os.path.join(self.path, name), "rb")
+			os.utime(os.path.join(self.path, name))
+		except OSError:
+			return None
+		return f
+
+	def get(self, key):
+		f = self.open(key)
+		if f is None:
+			return None
+		with f:
+			return f.read()
+
+	def tempfile(self):
+		"""a new temporary file in the cache dir, as (fd, path), to be added with `put_file`"""
+		return tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+
+	def put_file(self, key, tmp):
+		"""move temporary file `tmp` in the cache as the entry for `key`"""
+		size = os.path.getsize(tmp)
+		if size > self.max_size:
+			os.unlink(tmp)
+			return
+		name = self._name(key)
+		os.replace(tmp, os.path.join(self.path, name))
+		with self.lock:
+			self.size += size - self.entries.pop(name, 0)
+			self.entries[name] = size
+			self._evict()
+
+	def put(self, key, data):
+		if len(data) > self.max_size:
+			return
+		fd, tmp = self.tempfile()
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		self.put_file(key, tmp)
+
+	def clear(self):
+		with self.lock:
+			max_size, self.max_size = self.max_size, 0
+			self._evict()
+			self.max_size = max_size
+
+	def _evict(self):
+		while self.size > self.max_size and self.entries:
+			name, size = self.entries.popitem(last=False)
+			self.size -= size
+			try:
+				os.unlink(os.path.join(self.path, name))
+			except OSError:
+				pass
+
+
+class PackCache(object):
+	""" upload-pack responses on disk, keyed by the negotiation that produced them.
+	Everything is dropped when a ref moves """
+	def __init__(self, path, max_size, git=GIT):
+		self.disk = DiskCache(path, max_size, "packs")
+		self.git = git
+		self.lock = threading.Lock()
+		self.stamp = None
+		self.building = {}
+		self.callbacks = {}
+
+	def key(self, request, protocol=""):
+		"""key for an upload-pack `request`, or None if it doesn't end the negotiation with a pack"""
+		lines = set()
+		done = False
+		for line in pkt_lines(request):
+			line = line.rstrip(b"\n")
+			if line == b"done":
+				done = True
+			if line.startswith((b"agent=", b"session-id=")):
+				continue
+			if line.startswith(b"want ") and line.count(b" ") > 1:
+				# protocol v0 sends capabilities after the first want
+				line, caps = line[5:].split(b" ", 1)
+				line = b"want " + line
+				lines.update(b"capability " + c for c in caps.split() if not c.startswith((b"agent=", b"session-id=")))
+			lines.add(line)
+		if not done:
+			return None
+
+		stamp = self.git.refs_stamp()
+		with self.lock:
+			if stamp != self.stamp:
+				if not self.stamp is None:
+					self.disk.clear()
+				self.stamp = stamp
+		h = hashlib.sha1(f"{stamp}\n{protocol}\n".encode())
+		h.update(b"\n".join(sorted(lines)))
+		return h.hexdigest()
+
+	def open(self, key, timeout=600):
+		"""open the response for `key`, waiting for it if it's being built"""
+		with self.lock:
+			event = self.building.get(key)
+		if not event is None:
+			event.wait(timeout)
+		return self.disk.open(key)
+
+	def start(self, key):
+		"""start building the response for `key`: returns a (fd, path) temporary file to write it to,
+		or None if someone else is building it"""
+		with self.lock:
+			if key in self.building:
+				return None
+			self.building[key] = threading.Event()
+			self.callbacks[key] = []
+		return self.disk.tempfile()
+
+	def on_built(self, key, callback):
+		"""call `callback` from the building thread once the response for `key` is built.
+		returns False, without calling it, if the response is not being built"""
+		with self.lock:
+			if not key in self.building:
+				return False
+			self.callbacks[key].append(callback)
+		return True
+
+	def finish(self, key, tmp, ok):
+		if ok:
+			self.disk.put_file(key, tmp)
 		else:
-			print("[ ] pygments ", end=" ")
-		print()
-		
-		self.use_gravatar = not options['nogravatar']
-		
-		if self.use_pygments:
-			self.formatter = HtmlFormatter(linenos=False, cssclass="source")
-		
-		self.tmpdir = tempfile.mkdtemp()
-		print ("temp dir: {0}".format(self.tmpdir))
-		
-		self.routes = {
-			re.compile(r'^/$') : self.index,
-			re.compile(r'^/refs/$') : self.refs,
-			re.compile(r'^/browse(?P<path>.*)$') : self.browse,
-			re.compile(r'^/view(?P<path>.*)$') : self.view,
-			re.compile(r'^/history(?P<path>.*)$') : self.history,
-			re.compile(r'^/commit/(?P<ref>[a-zA-Z0-9]*)/$') : self.commit,
-			re.compile(r'^/diff(?P<path>.*)$') : self.diff,
-			re.compile(r'^/wiki/(?P<path>.*)$') : self.wiki,
-		}
-		
-	def route(self, request):
+			os.unlink(tmp)
+		with self.lock:
+			self.building.pop(key).set()
+			callbacks = self.callbacks.pop(key)
+		for callback in callbacks:
+			callback()
+
+
+class PageCache(object):
+	""" LRU cache of rendered pages with a memory budget, optionally spilling evicted pages to a DiskCache """
+	def __init__(self, max_size, disk=None):
+		self.max_size = max_size
+		self.disk = disk
+		self.entries = OrderedDict()
+		self.size = 0
+		self.lock = threading.Lock()
+		self.hit = (("cache", "pages"), ("result", "hit"))
+		self.miss = (("cache", "pages"), ("result", "miss"))
+
+	def get(self, key):
+		with self.lock:
+			r = self.entries.get(key)
+			if not r is None:
+				self.entries.move_to_end(key)
+		if not r is None:
+			metrics.inc("git_serve_cache_requests_total", self.hit)
+			return r
+		if not self.disk is None:
+			data = self.disk.get(repr(key))
+			if not data is None:
+				status, ctype, body = data.split(b"\n", 2)
+				r = (int(status), ctype.decode(), body)
+				self._store(key, r, spill=False)
+				metrics.inc("git_serve_cache_requests_total", self.hit)
+				return r
+		metrics.inc("git_serve_cache_requests_total", self.miss)
+		return None
+
+	def put(self, key, r):
+		if len(r[2]) > self.max_size:
+			return
+		self._store(key, r, spill=True)
+
+	def _store(self, key, r, spill):
+		evicted = []
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if not old is None:
+				self.size -= len(old[2])
+			self.entries[key] = r
+			self.size += len(r[2])
+			while self.size > self.max_size:
+				ekey, er = self.entries.popitem(last=False)
+				self.size -= len(er[2])
+				evicted.append((ekey, er))
+		if spill and not self.disk is None:
+			for ekey, er in evicted:
+				self.disk.put(repr(ekey), b"%d\n%s\n%s" % (er[0], er[1].encode(), er[2]))
+
+
+class LastCommitIndex(object):
+	""" Last commit modifying each path of a ref.
+	Built with a single `git log --name-only` pass, updated with the new commits only when the ref moves """
+	def __init__(self, filename, git=GIT):
+		self.filename = filename
+		self.git = git
+		self.lock = threading.Lock()
+		self.tip = None
+		self.paths = {}
+		self.commits = {}
+		try:
+			with open(filename) as f:
+				data = json.load(f)
+			self.tip, self.paths, self.commits = data['tip'], data['paths'], data['commits']
+		except (OSError, ValueError, KeyError):
+			pass
+
+	def get(self, path):
+		"""returns (commit id, commit timestamp, subject), or None"""
+		sha = self.paths.get(path)
+		if sha is None:
+			return None
+		return (sha,) + tuple(self.commits[sha])
+
+	def _walk(self, *revs):
+		"""paths and commits touching them, for the commits in `revs`"""
+		paths = {}
+		commits = {}
+		sha = None
+		tokens = nul_split(self.git.stream("log", "-z", "--name-only", "--no-renames", "--format=%x01%H%x09%ct%x09%s", *revs))
+		for token in tokens:
+			token = token.lstrip("\n")
+			if token.startswith("\x01"):
+				sha, ctime, subject = token[1:].split("\t", 2)
+				commit = (int(ctime), subject)
+				continue
+			if token == "" or token in paths:
+				continue
+			commits[sha] = commit
+			paths[token] = sha
+			# a directory was last modified by the last commit modifying any path below it
+			d = os.path.dirname(token)
+			while d != "" and not d in paths:
+				paths[d] = sha
+				d = os.path.dirname(d)
+		return paths, commits
+
+	def update(self, tip):
+		with self.lock:
+			if self.tip == tip:
+				return
+			if not self.tip is None and self.git.is_ancestor(self.tip, tip):
+				paths, commits = self._walk(f"{self.tip}..{tip}")
+				paths = dict(self.paths, **paths)
+				commits = dict(self.commits, **commits)
+				commits = {sha: commits[sha] for sha in set(paths.values())}
+			else:
+				paths, commits = self._walk(tip)
+			self.tip, self.paths, self.commits = tip, paths, commits
+
+			os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+			fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.filename), prefix=".tmp-")
+			with os.fdopen(fd, "w") as f:
+				json.dump({'tip': tip, 'paths': paths, 'commits': commits}, f)
+			os.replace(tmp, self.filename)
+
+
+# the columns of a CommitIndex. an update builds new ones and swaps them in, readers keep the ones they started with
+CommitColumns = namedtuple("CommitColumns", "tip width shas parents_end parents author authors atime ctime subjects")
+
+
+class CommitIndex(object):
+	""" Metadata of all the commits of a ref, one array per field.
+	Built with a single `rev-list` pass, updated with the new commits only when the ref moves.
+	Commits are stored parents first, the newest are at the end """
+	paths_cache_size = 32
+
+	def __init__(self, filename, git=GIT):
+		self.filename = filename
+		self.git = git
+		self.lock = threading.Lock()
+		self.paths_lock = threading.Lock()
+		self.columns = self._empty()
+		# (columns, raw commit id -> position), built on first use
+		self._positions = None
+		# path -> (tip, raw ids of the commits touching it up to tip)
+		self._paths = OrderedDict()
+		try:
+			with open(filename) as f:
+				data = json.load(f)
+			n, nparents, width = data['commits'], data['parents'], data['width']
+			with open(filename + ".columns", "rb") as f:
+				shas = f.read(width * n)
+				columns = []
+				for typecode, size in (("I", n), ("i", nparents), ("I", n), ("q", n), ("q", n)):
+					column = array(typecode)
+					column.fromfile(f, size)
+					columns.append(column)
+			parents_end, parents, author, atime, ctime = columns
+			self.columns = CommitColumns(data['tip'], width, shas, parents_end, parents, author, data['authors'], atime, ctime, data['subjects'])
+		except (OSError, ValueError, KeyError, EOFError):
+			pass
+
+	@staticmethod
+	def _empty():
+		# parents of commit i are parents[parents_end[i-1]:parents_end[i]], as positions. -1 if not indexed.
+		# commit ids are `width` bytes: 20, or 32 in sha256 repositories
+		return CommitColumns(None, 20, b"", array("I"), array("i"), array("I"), [], array("q"), array("q"), [])
+
+	@property
+	def tip(self):
+		return self.columns.tip
+
+	def __len__(self):
+		return len(self.columns.author)
+
+	def sha(self, pos, columns=None):
+		c = columns or self.columns
+		return c.shas[c.width*pos:c.width*(pos+1)].hex()
+
+	def position(self, sha, columns=None):
+		"""position of commit `sha` (full id), or None"""
+		c = columns or self.columns
+		positions = self._positions
+		if positions is None or not positions[0] is c:
+			w = c.width
+			positions = self._positions = (c, {c.shas[i:i+w]: i // w for i in range(0, len(c.shas), w)})
+		return positions[1].get(bytes.fromhex(sha))
+
+	def update(self, tip):
+		with self.lock:
+			old = self.columns
+			if old.tip == tip:
+				return
+			width = len(tip) // 2
+			if not old.tip is None and old.width == width and self.git.is_ancestor(old.tip, tip):
+				revs = f"{old.tip}..{tip}"
+				# copies, readers still use the current columns
+				c = CommitColumns(tip, width, bytearray(old.shas), array("I", old.parents_end), array("i", old.parents), array("I", old.author),
+					list(old.authors), array("q", old.atime), array("q", old.ctime), list(old.subjects))
+			else:
+				revs = tip
+				old = None
+				c = self._empty()._replace(tip=tip, width=width, shas=bytearray())
+
+			author_ids = {a: i for i, a in enumerate(c.authors)}
+			new = {}
+			lines = self.git.stream("rev-list", "--reverse", "--topo-order", "--format=%H%x00%P%x00%an <%ae>%x00%at%x00%ct%x00%s", revs)
+			for line in chain.from_iterable(text.split("\n") for text in text_chunks(lines)):
+				if line == "" or line.startswith("commit "):
+					continue
+				sha, parents, author, atime, ctime, subject = line.split("\0", 5)
+				for parent in parents.split():
+					pos = new.get(parent)
+					if pos is None and not old is None:
+						pos = self.position(parent, old)
+					c.parents.append(-1 if pos is None else pos)
+				new[sha] = len(c.author)
+				c.shas.extend(bytes.fromhex(sha))
+				c.parents_end.append(len(c.parents))
+				aid = author_ids.get(author)
+				if aid is None:
+					aid = author_ids[author] = len(c.authors)
+					c.authors.append(author)
+				c.author.append(aid)
+				c.atime.append(int(atime))
+				c.ctime.append(int(ctime))
+				c.subjects.append(subject)
+			if old is None:
+				# positions changed, and cached tips may not be ancestors anymore
+				with self.paths_lock:
+					self._paths = OrderedDict()
+			self.columns = c._replace(shas=bytes(c.shas))
+			self._save(self.columns)
+
+	def _save(self, c):
+		os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.filename), prefix=".tmp-")
+		with os.fdopen(fd, "wb") as f:
+			f.write(c.shas)
+			for column in (c.parents_end, c.parents, c.author, c.atime, c.ctime):
+				column.tofile(f)
+		os.replace(tmp, self.filename + ".columns")
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.filename), prefix=".tmp-")
+		with os.fdopen(fd, "w") as f:
+			json.dump({'tip': c.tip, 'width': c.width, 'commits': len(c.author), 'parents': len(c.parents),
+				'authors': c.authors, 'subjects': c.subjects}, f)
+		os.replace(tmp, self.filename)
+
+	def touching(self, path, tip=None):
+		"""ids of the commits modifying `path` up to `tip` (the indexed one by default), as raw bytes.
+		a few paths are cached, when the index moves forward only the new commits are looked at"""
+		tip = tip or self.tip
+		with self.paths_lock:
+			cached = self._paths.get(path)
+			if not cached is None:
+				self._paths.move_to_end(path)
+		if not cached is None and cached[0] == tip:
+			return cached[1]
+		# the cache is emptied when the index is rebuilt, so a cached tip is an ancestor of the new one
+		revs = tip if cached is None else f"{cached[0]}..{tip}"
+		commits = {bytes.fromhex(sha) for sha in self.git._do("rev-list", revs, "--", path).split()}
+		if not cached is None:
+			commits |= cached[1]
+		with self.paths_lock:
+			self._paths[path] = (tip, commits)
+			while len(self._paths) > self.paths_cache_size:
+				self._paths.popitem(last=False)
+		return commits
+
+	def matches(self, start=None, author=None, message=None, after=None, before=None, path=None, columns=None):
+		"""yields positions of commits matching all the filters, newest first, from `start`.
+		`author` and `message` are case insensitive substrings, `after` and `before` bound the author time"""
+		c = columns or self.columns
+		pos = len(c.author) - 1 if start is None else start
+		authors = None
+		if author:
+			author = author.lower()
+			authors = {i for i, a in enumerate(c.authors) if author in a.lower()}
+		if message:
+			message = message.lower()
+		commits = self.touching(path, c.tip) if path else None
+		w = c.width
+		while pos >= 0:
+			if not ((authors is not None and not c.author[pos] in authors) or
+					(after is not None and c.atime[pos] < after) or
+					(before is not None and c.atime[pos] >= before) or
+					(message and not message in c.subjects[pos].lower()) or
+					(commits is not None and not c.shas[w*pos:w*(pos+1)] in commits)):
+				yield pos
+			pos -= 1
+
+	def row(self, pos, columns=None):
+		"""commit at `pos`, in the format of GIT.log rows"""
+		c = columns or self.columns
+		name, _, email = c.authors[c.author[pos]].rpartition(" <")
+		sha = self.sha(pos, c)
+		return [sha[:7], name, reltime(c.atime[pos]), c.subjects[pos], email.rstrip(">"), "", sha]
+
+
+class SearchIndex(object):
+	""" Trigram index of the text blobs of a ref.
+	Each blob gets a document id, and every trigram of its lowercased content maps to a sorted
+	array of the document ids containing it. When the ref moves only the blobs in the tree diff
+	are indexed. Posting lists are saved as one zlib stream next to a json file with the paths.
+	Queries intersect posting lists to find candidates, then check them against the blob content.
+	Updates build new lists and swap them in, queries only wait for the swap """
+	max_blob_size = 1 << 20
+	max_results = 100
+	max_lines = 5
+	# bytes of candidate blobs checked per query, for queries the trigrams can't narrow down
+	max_scan_size = 32 << 20
+
+	def __init__(self, filename, git=GIT):
+		self.filename = filename
+		self.git = git
+		self.lock = threading.Lock()
+		self.update_lock = threading.Lock()
+		self.tip = None
+		self.docs = []
+		self.paths = {}
+		self.postings = {}
+		self._doc_paths = None
+		try:
+			with open(filename) as f:
+				data = json.load(f)
+			postings = {}
+			with open(filename + ".postings", "rb") as f:
+				buf = memoryview(zlib.decompress(f.read()))
+			n = data['trigrams']
+			keys = array("I")
+			keys.frombytes(buf[:4*n])
+			counts = array("I")
+			counts.frombytes(buf[4*n:8*n])
+			offset = 8*n
+			for key, count in zip(keys, counts):
+				docs = postings[key] = array("I")
+				docs.frombytes(buf[offset:offset+4*count])
+				offset += 4*count
+			self.tip, self.docs, self.paths, self.postings = data['tip'], data['docs'], data['paths'], postings
+		except (OSError, ValueError, KeyError, zlib.error):
+			pass
+
+	@staticmethod
+	def trigrams(data):
+		"""trigrams of `data` lowercased, as tuples of 3 ints"""
+		data = data.lower()
+		return set(zip(data, data[1:], data[2:]))
+
+	@staticmethod
+	def key(trigram):
+		a, b, c = trigram
+		return (a << 16) | (b << 8) | c
+
+	def _add(self, sha, docs, postings):
+		"""index blob `sha` as a new document of `docs` in `postings`, a defaultdict of arrays keyed by trigram tuples.
+		returns its document id or None if it's not text"""
+		try:
+			sha, otype, data = self.git.cat(sha, "blob")
+		except CalledProcessError:
+			return None
+		if len(data) > self.max_blob_size or is_binary(data):
+			return None
+		doc = len(docs)
+		docs.append(sha)
+		for trigram in self.trigrams(data):
+			postings[trigram].append(doc)
+		return doc
+
+	def _blobs(self, tip):
+		"""(path, blob id) of all the files in `tip`"""
+		for token in nul_split(self.git.stream("ls-tree", "-r", "-z", "--full-tree", tip)):
+			info, path = token.split("\t", 1)
+			mode, otype, sha = info.split()
+			if otype == "blob":
+				yield path, sha
+
+	def _changes(self, old, new):
+		"""(path, blob id) of files changed from `old` to `new`. blob id is None for deleted files"""
+		tokens = nul_split(self.git.stream("diff-tree", "-r", "-z", "--no-renames", old, new))
+		for info in tokens:
+			path = next(tokens)
+			oldmode, newmode, oldsha, newsha, status = info.lstrip(":").split()
+			if status == "D" or newmode == "160000":
+				yield path, None
+			else:
+				yield path, newsha
+
+	def update(self, tip):
+		with self.update_lock:
+			if self.tip == tip:
+				return
+			live = len(set(self.paths.values()))
+			if self.tip is None or len(self.docs) > 2 * live + 1000:
+				# first build, or too many documents not in the tree anymore
+				docs, paths, postings = [], {}, {}
+				changes = self._blobs(tip)
+			else:
+				# copies, the current lists are still being searched
+				docs, paths, postings = list(self.docs), dict(self.paths), dict(self.postings)
+				changes = self._changes(self.tip, tip)
+			ids = {sha: doc for doc, sha in enumerate(docs)}
+			added = defaultdict(partial(array, "I"))
+			for path, sha in changes:
+				paths.pop(path, None)
+				if sha is None:
+					continue
+				doc = ids.get(sha)
+				if doc is None and not sha in ids:
+					doc = ids[sha] = self._add(sha, docs, added)
+				if not doc is None:
+					paths[path] = doc
+			for trigram, new in added.items():
+				key = self.key(trigram)
+				postings[key] = postings[key] + new if key in postings else new
+			with self.lock:
+				self.tip, self.docs, self.paths, self.postings = tip, docs, paths, postings
+				self._doc_paths = None
+			self._save()
+
+	def _save(self):
+		os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+		keys = array("I", self.postings.keys())
+		counts = array("I", (len(docs) for docs in self.postings.values()))
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.filename), prefix=".tmp-")
+		with os.fdopen(fd, "wb") as f:
+			z = zlib.compressobj(1)
+			f.write(z.compress(keys))
+			f.write(z.compress(counts))
+			for docs in self.postings.values():
+				f.write(z.compress(docs))
+			f.write(z.flush())
+		os.replace(tmp, self.filename + ".postings")
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.filename), prefix=".tmp-")
+		with os.fdopen(fd, "w") as f:
+			json.dump({'tip': self.tip, 'docs': self.docs, 'paths': self.paths, 'trigrams': len(keys)}, f)
+		os.replace(tmp, self.filename)
+
+	def doc_paths(self):
+		"""document id -> sorted list of paths"""
+		doc_paths = self._doc_paths
+		if doc_paths is None:
+			doc_paths = {}
+			for path, doc in self.paths.items():
+				doc_paths.setdefault(doc, []).append(path)
+			for paths in doc_paths.values():
+				paths.sort()
+			self._doc_paths = doc_paths
+		return doc_paths
+
+	@staticmethod
+	def literals(pattern):
+		"""literal strings any match of regex `pattern` must contain.
+		conservative: unknown constructs just end the current literal"""
+		if re.search(r"\(\?[aiLmsux-]+[:)]", pattern):
+			# inline flags may change what the literals mean
+			return []
+		literals = []
+		current = ""
+		i = 0
+		depth = 0
+		while i < len(pattern):
+			c = pattern[i]
+			if c == "\\" and i + 1 < len(pattern):
+				n = pattern[i+1]
+				i += 2
+				if depth == 0 and not n.isalnum():
+					current += n
+					continue
+				literals.append(current)
+				current = ""
+				continue
+			i += 1
+			if c == "(":
+				if depth == 0:
+					literals.append(current)
+					current = ""
+				depth += 1
+			elif c == ")":
+				depth = max(depth - 1, 0)
+			elif c == "|" and depth == 0:
+				# alternatives at the top level: nothing is required
+				return []
+			elif depth > 0:
+				continue
+			elif c in "?*{":
+				# the previous character is optional
+				literals.append(current[:-1])
+				current = ""
+				if c == "{":
+					i = pattern.find("}", i) + 1 or len(pattern)
+			elif c == "[":
+				literals.append(current)
+				current = ""
+				i = pattern.find("]", i + 1) + 1 or len(pattern)
+			elif c in ".^$+":
+				literals.append(current)
+				current = ""
+			else:
+				current += c
+		literals.append(current)
+		return [l for l in literals if len(l.encode()) >= 3]
+
+	def candidates(self, literals):
+		"""ids of the documents in the tree which may contain all of `literals`"""
+		live = set(self.paths.values())
+		for literal in literals:
+			for trigram in self.trigrams(literal.encode()):
+				docs = self.postings.get(self.key(trigram))
+				if docs is None:
+					return set()
+				live.intersection_update(docs)
+				if not live:
+					return live
+		return live
+
+	def search(self, regex, literals):
+		"""yields (paths, [(line number, line html)]) of documents matching compiled `regex`.
+		ends with (None, None) if it stopped after checking `max_scan_size` bytes of blobs"""
+		with self.lock:
+			doc_paths = self.doc_paths()
+			docs = sorted(self.candidates(literals), key=lambda doc: doc_paths[doc][0])
+			docs = [(doc_paths[doc], self.docs[doc]) for doc in docs]
+		scanned = 0
+		for paths, sha in docs:
+			if scanned > self.max_scan_size:
+				yield None, None
+				return
+			try:
+				data = self.git.cat(sha, "blob")[2]
+			except CalledProcessError:
+				continue
+			scanned += len(data)
+			data = data.decode("utf-8", "replace")
+			lines = []
+			for m in regex.finditer(data):
+				start = data.rfind("\n", 0, m.start()) + 1
+				if lines and lines[-1][2] == start:
+					continue
+				end = data.find("\n", m.end())
+				if end == -1:
+					end = len(data)
+				line = data[start:end]
+				snippet = ""
+				pos = 0
+				for lm in regex.finditer(line):
+					if lm.end() == lm.start():
+						continue
+					snippet += html.escape(line[pos:lm.start()]) + "<mark>" + html.escape(lm.group()) + "</mark>"
+					pos = lm.end()
+				snippet += html.escape(line[pos:])
+				lines.append((data.count("\n", 0, start) + 1, snippet, start))
+				if len(lines) >= self.max_lines:
+					break
+			if lines:
+				yield paths, [(n, snippet) for n, snippet, start in lines]
+
+
+class GITRequestContext(object):
+	""" Per-request state handed to controllers """
+	def __init__(self, request):
 		self.request = request
 		self.method = request.command
 
@@ -185,27 +1685,41 @@ class GITServePages(object):
 		path = request.path
 		query = ""
 		if "?" in path:
-			path, query = path.split("?")
+			path, query = path.split("?", 1)
 			
-		self.path_info  = path
+		# links quote file names
+		self.path_info = unquote(path)
 		self.query = parse_qs(query)
+		# name of the controller, for metrics
+		self.route = None
+		# extra response headers set by controllers
+		self.headers = {}
+		self.encodings = accepted_encodings(request.headers.get('Accept-Encoding', ""))
+		# ref the pages are about unless a query says otherwise, chosen on the refs page
+		self.current_ref = "HEAD"
+		cookie = SimpleCookie()
+		try:
+			cookie.load(request.headers.get('Cookie', ""))
+		except CookieError:
+			pass
+		if "ref" in cookie:
+			ref = unquote(cookie["ref"].value)
+			# never let it pass as an option to git
+			if ref and not ref.startswith("-"):
+				self.current_ref = ref
+		# content encoding for the response, if compressed
+		self.encoding = self.encodings[0] if self.encodings else None
 
-		controller = None
-		kwargs = {}
-		
-		for route_rg, route_controller in self.routes.items():
-			m = route_rg.match(path)
-			if m:
-				controller = route_controller
-				kwargs = m.groupdict()
-		
-		if not controller is None:
-			return controller(**kwargs)
 
-		return None
-	
-	def _tpl(self, text, title=""):
-		style="""
+class GITServePages(object):
+	""" Routing, controllers and template """
+	# archives built at the same time, shared by all the repositories
+	archive_builds = threading.BoundedSemaphore(2)
+	# indexes of each kind kept per repository, branches and tags only
+	max_indexes = 8
+	# byte ranges of blobs up to this size are cut from a single read
+	raw_buffer_size = 1 << 20
+	style = """
 			body {
 			  padding: 0px;
 			  margin: 0px;
@@ -244,6 +1758,21 @@ class GITServePages(object):
 			li.file {
 			  list-style-image: url(data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAMAAAAoLQ9TAAAAP1BMVEUAAACBgYGVlZWZmZnExMTFxcXGxsbHx8fIyMjq6urr6+vs7Ozt7eXt7ebt7e3u7u7v7+/w8PDx8fHy8vL///9IyRz5AAAAAXRSTlMAQObYZgAAAGdJREFUGNNlj0sWgCAMA0FFPtUCxfufVahQeZrlTLKIWvUUVaOvKZoBeB9CAMDcgd+M2WusgKYBMQ4Q2E8N3uMBb6PpGE8BvI8pJQFtb51zAthnIuoAH09UBsBWyFQG+HxZ5reL+ucG2iMI0Xh/di8AAAAASUVORK5CYII=);
 			}
+			ul.tree li .lastcommit {
+			  float: right;
+			  color: #666;
+			}
+			ul.tree li .lastcommit a {
+			  color: #666;
+			}
+			ul.tree li .size {
+			  color: #888;
+			}
+			ul.tree li {
+			  clear: both;
+			  padding: 0.1em 0;
+			  border-bottom: 1px solid #ddd;
+			}
 			header > nav #ref {
 			  float: right;
 			}
@@ -312,29 +1841,76 @@ class GITServePages(object):
 			  margin-top: 1em;
 			  text-align: right;
 			}
+			table.search td.ln {
+			  color: #888;
+			  text-align: right;
+			  padding-right: 1em;
+			}
+			table.search code {
+			  white-space: pre-wrap;
+			}
+			mark {
+			  background-color: #ffe27a;
+			}
+			form.filters {
+			  margin-bottom: 1em;
+			}
+			table.diffstat td.num {
+			  text-align: right;
+			  padding-right: 1em;
+			  white-space: nowrap;
+			}
+			.added {
+			  color: #2a8a2a;
+			}
+			.deleted {
+			  color: #c33;
+			}
+			div.file h4 {
+			  margin-bottom: 0.3em;
+			}
+			table.blame {
+			  border-collapse: collapse;
+			  font-family: monospace;
+			}
+			table.blame td {
+			  padding: 0 0.5em;
+			  vertical-align: top;
+			}
+			table.blame td.commit {
+			  white-space: nowrap;
+			  color: #555;
+			}
+			table.blame td.ln {
+			  color: #888;
+			  text-align: right;
+			}
+			table.blame td.code {
+			  white-space: pre;
+			}
+			table.blame tr.start td {
+			  border-top: 1px solid #ddd;
+			}
 
 		"""
-		if self.use_pygments:
-			style +=  self.formatter.get_style_defs()
-		
-		return """<!DOCTYPE html>
+
+	page = """<!DOCTYPE html>
 			<head>
 				<meta charset="UTF-8">
 				<title>~{repo_name} {title}</title>
-				<style>
-					{style}
-				</style>
+				<link rel="stylesheet" href="{base}/static/{style_version}/style.css">
 			</head>
 			<body>
 				<header>
 					<nav>
 						<strong>~{repo_name}</strong> 
-						- <a href="/">home</a>
-						- <a href="/browse/">browse</a>
-					  	- <a href="/history/">history</a>
-					   	- <a href="/refs/">refs</a>
-					   	- <a href="/wiki/">wiki</a>
-					   	<a href="/refs/" id='ref'>{ref}</a>
+						- <a href="{base}/">home</a>
+						- <a href="{base}/browse/">browse</a>
+					  	- <a href="{base}/history/">history</a>
+					   	- <a href="{base}/refs/">refs</a>
+					   	- <a href="{base}/wiki/">wiki</a>
+					   	- <a href="{base}/search">search</a>
+					   	<a href="{base}/refs/" id='ref'>{ref}</a>
 				   	</nav>
 			   	</header>
 				<article>{content}</article>
@@ -343,129 +1919,874 @@ class GITServePages(object):
 					<path style="fill:#ffffff;fill-opacity:1;fill-rule:nonzero;stroke:none" d="M 6.3125 0 C 6.2098764 0.017375 6.1199182 0.0695 6.03125 0.125 C 4.9586289 0.7423 3.8462846 1.38955 2.90625 1.90625 L 0 12.8125 L 5.9375 14.40625 L 8.875 3.5 C 8.288629 2.4692 7.680842 1.43665 7.09375 0.40625 C 6.99554 0.22185 6.8427512 0.08965 6.625 0.03125 C 6.5161246 0.00225 6.4151236 -0.017375 6.3125 0 z M 5.9375 0.96875 C 6.4685738 0.96875 6.90625 1.3751761 6.90625 1.90625 C 6.90625 2.4373239 6.4685738 2.875 5.9375 2.875 C 5.4064261 2.875 4.96875 2.4373239 4.96875 1.90625 C 4.96875 1.3751761 5.4064261 0.96875 5.9375 0.96875 z "  />
 					</mask></defs></svg>
 			</body>
-		""".format(
-			title=title,
-			repo_name=self.request.repo_name,
-			host=self.request.server.server_name,
-			port=self.request.server.server_port,
-			style=style,
-			content=text,
-			ref=GIT.current_ref
-		)
+		"""
+
+	def __init__(self, options, git=GIT, base="", highlight_cache=None):
+		"""pages of the repository `git` works on, served under url path `base`.
+		`highlight_cache` can be shared between repositories"""
+		self.use_md = not markdown is None
+		self.use_pygments = not highlight is None
+		self.git = git
+		self.base = base
+		
+		self.use_gravatar = not options['nogravatar']
+		
+		if self.use_pygments:
+			self.formatter = HtmlFormatter(linenos=False, cssclass="source")
+			self.formatter_key = repr(sorted(self.formatter.options.items()))
+			self.formatter_nowrap = HtmlFormatter(linenos=False, cssclass="source", nowrap=True)
+		
+		# style sheet is served as a static file, versioned by its content
+		if self.use_pygments:
+			self.style = self.style + self.formatter.get_style_defs()
+		self.style_version = hashlib.sha1(self.style.encode()).hexdigest()[:12]
+		self.shells = {}
+
+		self.cache_dir = options.get('cache_dir') or default_cache_dir()
+		self.highlight_cache = highlight_cache
+		if highlight_cache is None and options.get('highlight_cache_size', 256 << 20):
+			self.highlight_cache = DiskCache(os.path.join(self.cache_dir, "highlight"), options.get('highlight_cache_size', 256 << 20), "highlight")
+		self.max_highlight_size = options.get('max_highlight_size', 512 << 10)
+		self.max_view_size = options.get('max_view_size', 16 << 20)
+
+		self.min_compress_size = options.get('min_compress_size', 1024)
+
+		self.page_size = options.get('page_size', 40)
+		self.max_diff_file_lines = options.get('max_diff_file_lines', 1000)
+		self.max_diff_lines = options.get('max_diff_lines', 10000)
+		self.refs_page_size = 100
+		self.log_pages = OrderedDict()
+		self.log_pages_lock = threading.Lock()
+		self.prefetch = ThreadPoolExecutor(max_workers=1, thread_name_prefix="git-serve-prefetch")
+
+		git_dir = self.git.git_dirs()[1]
+		self.repo_cache_dir = os.path.join(self.cache_dir, "repos", hashlib.sha1(git_dir.encode()).hexdigest()[:16])
+		self.indexes = OrderedDict()
+		self.indexes_lock = threading.Lock()
+		self.indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="git-serve-index")
+		# building the search index of a big tree takes a while, don't hold back the other indexes
+		self.search_indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="git-serve-search")
+		
+		name = os.path.basename(git_dir.rstrip("/"))
+		if name == ".git":
+			name = os.path.basename(os.path.dirname(git_dir.rstrip("/")))
+		self.name = name[:-4] if name.endswith(".git") else name
+		self.archives = None
+		if options.get('archive_cache_size', 512 << 20):
+			self.archives = DiskCache(os.path.join(self.repo_cache_dir, "archives"), options.get('archive_cache_size', 512 << 20), "archives")
+		self.archives_building = set()
+		self.archives_lock = threading.Lock()
+		self.blames = None
+		if options.get('blame_cache_size', 256 << 20):
+			self.blames = DiskCache(os.path.join(self.repo_cache_dir, "blame"), options.get('blame_cache_size', 256 << 20), "blame")
+
+		self.tmpdir = tempfile.mkdtemp()
+
+		disk_cache = None
+		if options.get('disk_cache_size'):
+			disk_cache = DiskCache(os.path.join(self.tmpdir, "pages"), options['disk_cache_size'], "pages-disk")
+		self.cache = PageCache(options.get('cache_size', 64 << 20), disk_cache)
+		
+		self.routes = {
+			re.compile(r'^/$') : self.index,
+			re.compile(r'^/refs/$') : self.refs,
+			re.compile(r'^/browse(?P<path>.*)$') : self.browse,
+			re.compile(r'^/view(?P<path>.*)$') : self.view,
+			re.compile(r'^/raw(?P<path>.*)$') : self.raw,
+			re.compile(r'^/archive/(?P<ref>.+)\.(?P<fmt>tar\.gz|zip)$') : self.archive,
+			re.compile(r'^/history(?P<path>.*)$') : self.history,
+			re.compile(r'^/blame(?P<path>.*)$') : self.blame,
+			re.compile(r'^/commit/(?P<ref>[a-zA-Z0-9]*)/$') : self.commit,
+			re.compile(r'^/diff(?P<path>.*)$') : self.diff,
+			re.compile(r'^/wiki/(?P<path>.*)$') : self.wiki,
+			re.compile(r'^/search$') : self.search,
+			re.compile(r'^/static/(?P<version>[0-9a-f]+)/style\.css$') : self.static_style,
+		}
+		
+	def route(self, ctx):
+		controller = None
+		kwargs = {}
+		
+		if self.base:
+			if not ctx.path_info.startswith(self.base + "/"):
+				return None
+			ctx.path_info = ctx.path_info[len(self.base):]
+
+		for route_rg, route_controller in self.routes.items():
+			m = route_rg.match(ctx.path_info)
+			if m:
+				controller = route_controller
+				kwargs = m.groupdict()
+		
+		if not controller is None:
+			ctx.route = controller.__name__
+			return controller(ctx, **kwargs)
+
+		return None
+
+	def _etag_matches(self, ctx, etag, immutable=False):
+		"""set the ETag and caching headers, True if the client has that version already"""
+		ctx.headers['ETag'] = etag
+		if immutable:
+			ctx.headers['Cache-Control'] = "public, max-age=31536000, immutable"
+		else:
+			ctx.headers['Cache-Control'] = "no-cache"
+		if_none_match = ctx.request.headers.get('If-None-Match', "")
+		return etag in [t.strip() for t in if_none_match.split(",")] or if_none_match.strip() == "*"
+
+	def _cached(self, ctx, key, render, immutable=False):
+		"""serve the page for `key` from cache, or render and store it.
+		`key` must only contain fully resolved object ids, never symbolic refs.
+		`immutable` tells that the request addressed the page by object ids only, and that it doesn't
+		show the current ref: pages in the template do, they are revalidated with their ETag"""
+		# the page header shows the current ref
+		key = key + (ctx.current_ref,)
+		etag = hashlib.sha1(repr(key).encode()).hexdigest()
+		if ctx.encoding:
+			etag += "-" + ctx.encoding
+		etag = f'"{etag}"'
+		if self._etag_matches(ctx, etag, immutable):
+			return (304, "", b"")
+
+		r = self.cache.get(key)
+		if r is None:
+			r = render()
+			if not r is None and r[0] == 200 and isinstance(r[2], str):
+				# streamed pages are too big to be cached
+				r = (r[0], r[1], r[2].encode("utf-8"))
+				self.cache.put(key, r)
+
+		if not r is None and r[0] == 200 and ctx.encoding and isinstance(r[2], bytes) and len(r[2]) >= self.min_compress_size:
+			# compressed pages are cached as well
+			ckey = key + (ctx.encoding,)
+			c = self.cache.get(ckey)
+			if c is None:
+				c = (r[0], r[1], compress(r[2], ctx.encoding))
+				self.cache.put(ckey, c)
+			ctx.headers['Content-Encoding'] = ctx.encoding
+			r = c
+		return r
 	
-	def _hi(self, text, path="none.txt"):
+	def close(self):
+		"""stop background work and drop the temp dir"""
+		for executor in (self.prefetch, self.indexer, self.search_indexer):
+			executor.shutdown(wait=False, cancel_futures=True)
+		shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+	def _shell(self, ctx):
+		"""the page template, split around title, current ref and content. built once per host"""
+		key = (ctx.request.repo_name, ctx.request.server.server_name, ctx.request.server.server_port)
+		shell = self.shells.get(key)
+		if shell is None:
+			shell = self.page.format(
+				repo_name=ctx.request.repo_name,
+				base=self.base,
+				host=ctx.request.server.server_name,
+				port=ctx.request.server.server_port,
+				style_version=self.style_version,
+				title="\0",
+				ref="\0",
+				content="\0",
+			).split("\0")
+			self.shells[key] = shell
+		return shell
+
+	def _tpl(self, ctx, text, title=""):
+		head, after_title, after_ref, tail = self._shell(ctx)
+		return head + title + after_title + html.escape(ctx.current_ref) + after_ref + text + tail
+
+	def _tpl_stream(self, ctx, chunks, title=""):
+		"""like `_tpl`, but yields the page in chunks"""
+		head, after_title, after_ref, tail = self._shell(ctx)
+		yield head + title + after_title + html.escape(ctx.current_ref) + after_ref
+		for chunk in chunks:
+			yield chunk
+		yield tail
+
+	def _hi(self, text, path="none.txt", sha=None, nowrap=False):
+		"""highlight `text`. results are cached by `sha`, the blob id of `text`,
+		or by the hash of `text` if no blob id is given.
+		with `nowrap` there's no <pre> around, and each line can be used alone"""
 		fname = os.path.basename(path)
-		if not self.use_pygments:
-			return "<pre>"+cgi.escape(text)+"</pre>"
+		plain = html.escape(text) if nowrap else "<pre>"+html.escape(text)+"</pre>"
+		if not self.use_pygments or len(text) > self.max_highlight_size:
+			return plain
 		try:
 			lexer = get_lexer_for_filename(fname, text)
-			return highlight(text, lexer, self.formatter)
 		except Exception:
-			return "<pre>"+cgi.escape(text)+"</pre>"
+			return plain
+		formatter = self.formatter_nowrap if nowrap else self.formatter
+
+		if self.highlight_cache is None:
+			with metrics.timer("git_serve_step_duration_seconds", (("step", "highlight"),)):
+				return highlight(text, lexer, formatter)
+
+		if sha is None:
+			sha = hashlib.sha1(text.encode("utf-8", "surrogateescape")).hexdigest()
+		key = f"{sha}|{lexer.name}|{self.formatter_key}"
+		if nowrap:
+			key += "|nowrap"
+		r = self.highlight_cache.get(key)
+		if r is None:
+			with metrics.timer("git_serve_step_duration_seconds", (("step", "highlight"),)):
+				r = highlight(text, lexer, formatter)
+			self.highlight_cache.put(key, r.encode("utf-8"))
+			return r
+		return r.decode("utf-8")
 	
-	def index(self):
+	def _hi_stream(self, chunks, path="none.txt"):
+		"""highlight text `chunks` one by one, for line based languages like diffs"""
+		try:
+			lexer = get_lexer_for_filename(os.path.basename(path))
+		except Exception:
+			lexer = None
+		if not self.use_pygments or lexer is None:
+			yield "<pre>"
+			for chunk in chunks:
+				yield html.escape(chunk)
+			yield "</pre>"
+			return
+		yield f"<div class='{self.formatter.cssclass}'><pre>"
+		for chunk in chunks:
+			with metrics.timer("git_serve_step_duration_seconds", (("step", "highlight"),)):
+				chunk = highlight(chunk, lexer, self.formatter_nowrap)
+			yield chunk
+		yield "</pre></div>"
+
+	def static_style(self, ctx, version):
+		if version != self.style_version:
+			return None
+		return self._cached(ctx, ("style", version), lambda: (200, "text/css", self.style), immutable=True)
+
+	def index(self, ctx):
 		txt_index = "Add a README to see something here. Call it README, README.txt or README.md"
 		
 		for fname in ('README.md', 'README', 'README.txt'):
-			readme = os.path.join(self.request.repo_path, fname)
+			readme = os.path.join(ctx.request.repo_path, fname)
 			if os.path.isfile( readme ):
 				with codecs.open(readme, mode="r", encoding="utf-8") as input_file:
 					text = input_file.read()
-				if self.use_md and fname.endswith(".md"):
+			else:
+				# bare repositories have no work tree
+				try:
+					text = self.git.show(fname, ctx.current_ref)
+				except CalledProcessError:
+					continue
+			if self.use_md and fname.endswith(".md"):
+				with metrics.timer("git_serve_step_duration_seconds", (("step", "markdown"),)):
 					txt_index = markdown.markdown(text)
-				else:
-					txt_index  = "<pre class='wrap'>{0}</pre>".format(text)
-				break
+			else:
+				txt_index  = "<pre class='wrap'>{0}</pre>".format(text)
+			break
 				
-		return (200, "text/html", self._tpl(txt_index))
+		return (200, "text/html", self._tpl(ctx, txt_index))
 		
 
-	def refs(self):
-		if "r" in self.query:
-			GIT.current_ref = self.query['r'][0]
-			return (302, '', '/history/')
+	def refs(self, ctx):
+		if "r" in ctx.query:
+			# the ref shown is a per client choice
+			ctx.headers['Set-Cookie'] = "ref={0}; Path={1}/; SameSite=Lax".format(quote(ctx.query['r'][0], safe=""), self.base)
+			return (302, '', f'{self.base}/history/')
 		
-		branches = GIT.branch()
-		tags = GIT.tag()
-		txt = "<ul><a href='?r=HEAD'>HEAD</a></li></ul>"
+		q = ctx.query.get("q", [""])[0]
+		branches = self.git.branch()
+		tags = self.git.tag()
+		if q != "":
+			branches = [k for k in branches if q in k]
+			tags = [k for k in tags if q in k]
+
+		txt = "<form method='get'><input name='q' value='{0}' placeholder='filter refs'> <input type='submit' value='filter'></form>".format(html.escape(q, True))
+		txt += "<ul><a href='?r=HEAD'>HEAD</a></li></ul>"
 		if len(branches):
 			txt += "<h3>Branches</h3>"
-			txt += "<ul>"
-			for k in branches:
-				txt += "<li><a class='ref' href='?r={0}'>{0}</a></li>".format(k)
-			txt += "</ul>"
+			txt += self._refs_list(ctx, branches, "pb")
 		else:
 			txt += "<h3>No branches</h3>"
 
-		if len(tags):
-			txt += "<h3>Tags</h3>"
-			txt += "<ul>"
-			for k in tags:
-				txt += "<li><a class='ref' href='?r={0}'>{0}</a></li>".format(k)
-			txt += "</ul>"
-		else:
-			txt += "<h3>No tags</h3>"
-		
-		return (200, "text/html", self._tpl(txt))
-		
+		if len(tags):
+			txt += "<h3>Tags</h3>"
+			txt += self._refs_list(ctx, tags, "pt")
+		else:
+			txt += "<h3>No tags</h3>"
+		
+		return (200, "text/html", self._tpl(ctx, txt))
+
+	def _refs_list(self, ctx, names, page_param):
+		"""one page of a list of refs. `page_param` is the query parameter with the page number"""
+		try:
+			page = max(int(ctx.query.get(page_param, ["0"])[0]), 0)
+		except ValueError:
+			page = 0
+		n = self.refs_page_size
+		txt = "<ul>"
+		for k in names[page*n:(page+1)*n]:
+			txt += "<li><a class='ref' href='?r={0}'>{0}</a> <small><a href='{1}/archive/{0}.tar.gz'>tar.gz</a> <a href='{1}/archive/{0}.zip'>zip</a></small></li>".format(k, self.base)
+		txt += "</ul>"
+
+		pages = []
+		query = {k: v[0] for k, v in ctx.query.items()}
+		if page > 0:
+			pages.append("<a href='?{0}'>&laquo; previous</a>".format(urlencode(dict(query, **{page_param: page - 1}))))
+		if (page+1)*n < len(names):
+			pages.append("<a href='?{0}'>next &raquo;</a>".format(urlencode(dict(query, **{page_param: page + 1}))))
+		if pages:
+			txt += "<p class='pages'>{0} of {1}: {2}</p>".format(
+				f"{page*n+1}-{min((page+1)*n, len(names))}", len(names), " - ".join(pages))
+		return txt
+		
+
+	def _indexed_ref(self, ref):
+		"""full name of branch or tag `ref`, or HEAD. None for other revisions, they are not indexed"""
+		if ref == "HEAD":
+			return ref
+		refs = self.git.refs()
+		for name in (ref, "refs/heads/" + ref, "refs/tags/" + ref):
+			if name.startswith(("refs/heads/", "refs/tags/")) and name in refs:
+				return name
+		return None
+
+	def _ref_index(self, cls, name, ref, wait, executor):
+		"""the index of class `cls` for branch or tag `ref`, or None if it can't be brought up to date within
+		`wait` seconds. updates run on `executor`. only the `max_indexes` last used of each class are kept"""
+		ref = self._indexed_ref(ref)
+		if ref is None:
+			return None
+		try:
+			tip = self.git.rev(ref)
+		except CalledProcessError:
+			return None
+		with self.indexes_lock:
+			if not (name, ref) in self.indexes:
+				fname = hashlib.sha1(ref.encode()).hexdigest() + ".json"
+				self.indexes[(name, ref)] = (cls(os.path.join(self.repo_cache_dir, name, fname), self.git), None)
+				self._evict_indexes(name)
+			self.indexes.move_to_end((name, ref))
+			index, future = self.indexes[(name, ref)]
+			if index.tip == tip:
+				return index
+			if future is None or future.done():
+				future = executor.submit(index.update, tip)
+				self.indexes[(name, ref)] = (index, future)
+		try:
+			future.result(timeout=wait)
+		except TimeoutError:
+			return None
+		except CalledProcessError:
+			logger.exception("git command error")
+			return None
+		return index if index.tip == tip else None
+
+	def _evict_indexes(self, name):
+		"""drop the least recently used indexes of kind `name` above `max_indexes`, in memory and on disk.
+		called with indexes_lock held"""
+		keys = [k for k in self.indexes if k[0] == name]
+		for key in keys[:-self.max_indexes]:
+			index, future = self.indexes[key]
+			if future is None or future.done():
+				del self.indexes[key]
+		# the files are named after the index, with extra columns as suffixes
+		kept = {os.path.basename(index.filename) for (kind, _), (index, _) in self.indexes.items() if kind == name}
+		path = os.path.join(self.repo_cache_dir, name)
+		try:
+			files = [(os.stat(os.path.join(path, f)).st_mtime, f) for f in os.listdir(path) if not f.startswith(".tmp-")]
+		except OSError:
+			return
+		stale = {}
+		for mtime, f in files:
+			base = f[:45]
+			if not base in kept:
+				stale[base] = max(stale.get(base, 0), mtime)
+		for base in sorted(stale, key=stale.get)[:max(len(stale) + len(kept) - self.max_indexes, 0)]:
+			for f in (base, base + ".columns", base + ".postings"):
+				try:
+					os.unlink(os.path.join(path, f))
+				except OSError:
+					pass
+
+	def _last_commits(self, ref, wait=1.0):
+		"""the LastCommitIndex of `ref`, or None if it's not ready"""
+		return self._ref_index(LastCommitIndex, "lastcommit", ref, wait, self.indexer)
+
+	def _search_index(self, ref, wait=2.0):
+		"""the SearchIndex of `ref`, or None if it's not ready"""
+		return self._ref_index(SearchIndex, "search", ref, wait, self.search_indexer)
+
+	def _last_commit(self, index, path):
+		if index is None:
+			return ""
+		last = index.get(path)
+		if last is None:
+			return ""
+		sha, ctime, subject = last
+		return f"<span class='lastcommit'><a href='{self.base}/commit/{sha}/'>{html.escape(subject)}</a> <span class='nw'>{reltime(ctime)}</span></span>"
+
+	def browse(self, ctx, path):
+		path = path.strip("/")
+		if path != "":
+			path += "/"
+		
+		dirs, files = self.git.files(path, ctx.current_ref)
+		if len(dirs) == 0 and len(files) == 0:
+			return None
+		
+		index = self._last_commits(ctx.current_ref)
+		
+		txt_browse = "<h3>"+path+"</h3>"
+		txt_browse += "<ul class='tree'>"
+		
+		if path!="":
+			txt_browse += "<li class='dir'><a href='{1}/browse/{0}..'>..</a></li>".format(path, self.base)
+
+		for e in dirs:
+			last = self._last_commit(index, path+e.name)
+			txt_browse += "<li class='dir'><a href='{3}/browse/{0}{1}'>{1}</a>{2}</li>".format(path,e.name,last,self.base)
+		
+		for e in files:
+			last = self._last_commit(index, path+e.name)
+			size = "" if e.size < 0 else " <small class='size'>{0}</small>".format(human_size(e.size))
+			txt_browse += "<li class='file'><a href='{4}/view/{0}{1}'>{1}</a>{3}{2}</li>".format(path,e.name,last,size,self.base)
+		
+		txt_browse += "</ul>"
+		return (200, "text/html", self._tpl(ctx, txt_browse))
+	
+	def view(self, ctx, path):
+		ref = ctx.query.get('ref', [ctx.current_ref])[0]
+		path = path.strip("/")
+		try:
+			sha = self.git.rev(ref)
+		except CalledProcessError:
+			logger.exception("git command error")
+			return None
+		return self._cached(ctx, ("view", path, ref, sha), partial(self._view, ctx, path, ref))
+
+	def _view(self, ctx, path, ref):
+		try:
+			blob = self.git.resolve(f"{ref}:{path}")
+			if blob is None or blob[1] != "blob":
+				raise CalledProcessError(128, ['git', 'show', f"{ref}:{path}"])
+			logs = self.git.log(path, ref, n=2)[-1]
+		except CalledProcessError:
+			logger.exception("git command error")
+			return None
+		sha, otype, size = blob
+		
+		txt = "<h3>{0} <span class='ref'>@{1}</span></h3>".format(path, ref)
+		txt += "<p><a href='{3}/history/{1}'>History</a> - <a href='{3}/blame/{1}?ref={0}'>Blame</a> - <a href='{3}/raw/{1}?ref={0}'>Raw</a> - Show diff: ".format(ref,path, logs[0], self.base)
+		
+		if ref!= logs[0]:
+			txt += "<a href='{3}/diff/{1}?ref={2}..{0}'>previus</a> - ".format(ref,path, logs[0], self.base)
+		
+		txt += "<a href='{3}/diff/{1}?ref={0}..HEAD'>HEAD</a></p>".format(ref,path, logs[0], self.base)
+
+		if size > self.max_view_size:
+			txt += f"<p>File is too big to be shown ({size} bytes).</p>"
+			return (200, "text/html", self._tpl(ctx, txt))
+
+		if size <= self.max_highlight_size:
+			data = self.git.cat(sha)[2]
+			if is_binary(data):
+				txt += f"<p>Binary file ({size} bytes).</p>"
+			else:
+				txt += self._hi(data.decode("utf-8", "replace"), path, sha)
+			return (200, "text/html", self._tpl(ctx, txt))
+
+		# too big to be highlighted, stream it
+		chunks = self.git.cat_stream(sha)
+		first = next(chunks, b"")
+		if is_binary(first):
+			chunks.close()
+			txt += f"<p>Binary file ({size} bytes).</p>"
+			return (200, "text/html", self._tpl(ctx, txt))
+		return (200, "text/html", self._tpl_stream(ctx, chain(
+			[txt, "<pre>"],
+			(html.escape(t) for t in text_chunks(chain([first], chunks))),
+			["</pre>"],
+		)))
+
+	def raw(self, ctx, path):
+		"""the bytes of a file, streamed from git. single and multiple byte ranges are honored"""
+		ref = ctx.query.get('ref', [ctx.current_ref])[0]
+		path = path.strip("/")
+		blob = self.git.resolve(f"{ref}:{path}")
+		if blob is None or blob[1] != "blob":
+			return None
+		sha, otype, size = blob
+
+		etag = f'"{sha}"'
+		ctx.headers['Accept-Ranges'] = "bytes"
+		# files of the repository must not run scripts with the origin of the pages
+		ctx.headers['X-Content-Type-Options'] = "nosniff"
+		ctx.headers['Content-Security-Policy'] = "sandbox"
+		if ctx.query.get('download'):
+			ctx.headers['Content-Disposition'] = "attachment; filename*=UTF-8''" + quote(os.path.basename(path))
+		if self._etag_matches(ctx, etag, self.git.is_sha(ref)):
+			return (304, "", b"")
+
+		mime = self._raw_type(path, sha, size)
+		ranges = None
+		header = ctx.request.headers.get('Range')
+		if_range = ctx.request.headers.get('If-Range')
+		if header and (if_range is None or if_range.strip() == etag):
+			ranges = parse_range(header, size)
+
+		if ranges is None:
+			ctx.headers['Content-Length'] = size
+			return (200, mime, self.git.cat_stream(sha))
+		if not ranges:
+			ctx.headers['Content-Range'] = f"bytes */{size}"
+			return (416, "text/plain", b"")
+		data = None
+		if size <= self.raw_buffer_size:
+			data = memoryview(self.git.cat(sha)[2])
+
+		def part(start, end):
+			if not data is None:
+				return iter([data[start:end + 1]])
+			# cat-file can't seek: the start is read and dropped, and the rest too if it's short,
+			# a worker closed before the end of the object can't go back to the pool
+			return byte_range(self.git.cat_stream(sha), start, end, self.raw_buffer_size)
+
+		if len(ranges) == 1:
+			start, end = ranges[0]
+			ctx.headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+			ctx.headers['Content-Length'] = end - start + 1
+			return (206, mime, part(start, end))
+
+		boundary = os.urandom(12).hex()
+		parts = [(f"\r\n--{boundary}\r\nContent-Type: {mime}\r\nContent-Range: bytes {start}-{end}/{size}\r\n\r\n".encode(), start, end)
+			for start, end in ranges]
+		tail = f"\r\n--{boundary}--\r\n".encode()
+		ctx.headers['Content-Length'] = sum(len(head) + end - start + 1 for head, start, end in parts) + len(tail)
+
+		def body():
+			for head, start, end in parts:
+				yield head
+				yield from part(start, end)
+			yield tail
+
+		return (206, f"multipart/byteranges; boundary={boundary}", body())
+
+	def archive(self, ctx, ref, fmt):
+		"""`git archive` of `ref`, streamed while it's built. archives are cached by commit and format.
+		they are built from the commit, so the file times are the commit time and the bytes are the same every time"""
+		commit = self.git.resolve(f"{ref}^{{commit}}")
+		if commit is None:
+			return None
+		commit = commit[0]
+		name = "{0}-{1}".format(self.name, re.sub(r'[^A-Za-z0-9._-]+', "-", ref))
+		key = f"{commit} {fmt} {name}"
+		ctx.headers['Content-Disposition'] = "attachment; filename*=UTF-8''{0}.{1}".format(quote(name), fmt)
+		if self._etag_matches(ctx, '"{0}"'.format(hashlib.sha1(key.encode()).hexdigest()), self.git.is_sha(ref)):
+			return (304, "", b"")
+		mime = "application/zip" if fmt == "zip" else "application/gzip"
+
+		f = None if self.archives is None else self.archives.open(key)
+		if not f is None:
+			ctx.headers['Content-Length'] = os.fstat(f.fileno()).st_size
+			return (200, mime, file_chunks(f))
+
+		# don't let archive builds take all the workers
+		if not self.archive_builds.acquire(blocking=False):
+			ctx.headers['Retry-After'] = 10
+			return (503, "text/plain", b"Too many archives are being built, retry later.\n")
+		body = self._archive_build(key, commit, fmt, name)
+		# from here the build slot is given back when the body is closed
+		next(body)
+		return (200, mime, body)
+
+	def _archive_build(self, key, commit, fmt, name):
+		"""yields the archive of `commit` as git builds it, keeping a copy in the cache.
+		the build slot must be taken, it's released at the end"""
+		out = None
+		ok = False
+		try:
+			yield b""
+			with self.archives_lock:
+				if not self.archives is None and not key in self.archives_building:
+					self.archives_building.add(key)
+					fd, tmp = self.archives.tempfile()
+					out = os.fdopen(fd, "wb")
+			chunks = self.git.stream("archive", f"--format={fmt}", f"--prefix={name}/", commit)
+			try:
+				for chunk in chunks:
+					if not out is None:
+						out.write(chunk)
+					yield chunk
+			finally:
+				chunks.close()
+			ok = True
+		finally:
+			self.archive_builds.release()
+			if not out is None:
+				out.close()
+				if ok:
+					self.archives.put_file(key, tmp)
+				else:
+					os.unlink(tmp)
+				with self.archives_lock:
+					self.archives_building.discard(key)
+
+	def blame(self, ctx, path):
+		"""who last changed each line of a file. blames are cached by the last commit changing the file;
+		when missing they are derived from the cached blame of the commit changing it before, or streamed from git"""
+		ref = ctx.query.get('ref', [ctx.current_ref])[0]
+		path = path.strip("/")
+		try:
+			sha = self.git.rev(ref)
+		except CalledProcessError:
+			logger.exception("git command error")
+			return None
+		# the page only depends on the tip and the path, look it up before any other git work
+		return self._cached(ctx, ("blame", path, ref, sha), partial(self._blame_render, ctx, path, ref, sha))
+
+	def _blame_render(self, ctx, path, ref, sha):
+		try:
+			blob = self.git.resolve(f"{sha}:{path}")
+			if blob is None or blob[1] != "blob":
+				raise CalledProcessError(128, ['git', 'blame', sha, '--', path])
+			commit = self.git.last_change(sha, path)
+			blame = self._blame_cached(commit, path)
+		except CalledProcessError:
+			logger.exception("git command error")
+			return None
+
+		if not blame is None:
+			return self._blame_page(ctx, path, ref, blob, blame)
+		r = self._blame_lines(path, ref, blob)
+		if isinstance(r, str):
+			return (200, "text/html", self._tpl(ctx, r))
+		return (200, "text/html", self._tpl_stream(ctx, self._blame_stream(path, ref, commit, r)))
+
+	def _blame_cached(self, commit, path):
+		"""the blame of `path` at `commit` from the cache, or derived from the cached blame
+		at the commit that changed it before, if `commit` has a single parent. None if it's not there"""
+		if self.blames is None:
+			return None
+		data = self.blames.get(f"{commit}:{path}")
+		if not data is None:
+			return json.loads(data)
+		if not self.git.resolve(f"{commit}^2") is None:
+			return None
+		before = self.git.resolve(f"{commit}^:{path}")
+		if before is None:
+			return None
+		prev = self.git.last_change(f"{commit}^", path)
+		prev_blob = self.git.resolve(f"{prev}:{path}")
+		if prev_blob is None or prev_blob[0] != before[0]:
+			return None
+		data = self.blames.get(f"{prev}:{path}")
+		if data is None:
+			return None
+		author, author_time, summary = self.git._do("log", "-1", "--format=%an%x00%at%x00%s", commit).rstrip("\n").split("\0")
+		after = self.git.resolve(f"{commit}:{path}")
+		blame = derive_blame(json.loads(data), self.git.diff_hunks(before[0], after[0]), commit, [author, int(author_time), summary], path)
+		if not blame is None:
+			self.blames.put(f"{commit}:{path}", json.dumps(blame).encode("utf-8"))
+		return blame
+
+	def _blame_lines(self, path, ref, blob):
+		"""the header of the blame page and the highlighted lines of the file,
+		or the whole page as a string if the file can't be shown"""
+		sha, otype, size = blob
+		txt = "<h3>{0} <span class='ref'>@{1}</span></h3>".format(html.escape(path), html.escape(ref))
+		txt += "<p><a href='{2}/view/{0}?ref={1}'>View</a> - <a href='{2}/history/{0}'>History</a></p>".format(html.escape(path, True), html.escape(ref, True), self.base)
+		if size > self.max_view_size:
+			return txt + f"<p>File is too big to be shown ({size} bytes).</p>"
+		data = self.git.cat(sha)[2]
+		if is_binary(data):
+			return txt + f"<p>Binary file ({size} bytes).</p>"
+		text = data.decode("utf-8", "replace")
+		n = text.count("\n") + (0 if text.endswith("\n") or text == "" else 1)
+		return txt, self._hi(text, path, sha, nowrap=True).split("\n")[:n]
+
+	def _blame_cell(self, sha, info):
+		"""the commit column of the first line blamed on commit `sha`"""
+		author, author_time, summary = info
+		return "<a href='{0}/commit/{1}/' title='{2}'>{3}</a> {4} {5}".format(
+			self.base, sha, html.escape(summary, True), sha[:7], html.escape(author), time.strftime("%Y-%m-%d", time.gmtime(author_time)))
+
+	def _blame_table(self, lines):
+		"""the table of the blame page, with the commit column empty"""
+		rows = ["<div class='source'><table class='blame'>"]
+		for n, line in enumerate(lines, 1):
+			rows.append(f"<tr id='b{n}'><td class='commit'></td><td class='ln'>{n}</td><td class='code'>{line}</td></tr>")
+		rows.append("</table></div>")
+		return rows
 
-	def browse(self,path):
-		path = path.strip("/")
-		if path != "":
-			path += "/"
-		
-		dirs, files = GIT.files(path)
-		if len(dirs) == 0 and len(files) == 0:
+	def _blame_page(self, ctx, path, ref, blob, blame):
+		r = self._blame_lines(path, ref, blob)
+		if isinstance(r, str):
+			return (200, "text/html", self._tpl(ctx, r))
+		txt, lines = r
+		rows = self._blame_table(lines)
+		for sha, orig, final, count, fname in blame['entries']:
+			if final > len(lines):
+				continue
+			cell = self._blame_cell(sha, blame['commits'][sha])
+			rows[final] = rows[final].replace("<tr ", "<tr class='start' ", 1).replace("<td class='commit'></td>", f"<td class='commit'>{cell}</td>", 1)
+		return (200, "text/html", self._tpl(ctx, txt + "".join(rows)))
+
+	def _blame_stream(self, path, ref, commit, r):
+		"""the blame page, with the commits filled in by scripts as `git blame --incremental` finds them.
+		the blame is cached when git is done"""
+		txt, lines = r
+		yield txt
+		yield from self._blame_table(lines)
+		yield """<script>
+			function blame(entries) {
+				entries.forEach(function(e) {
+					var row = document.getElementById("b" + e[0]);
+					row.className = "start";
+					row.cells[0].innerHTML = e[1];
+				});
+			}
+		</script>"""
+		parser = BlameParser()
+		entries = []
+		chunks = self.git.stream("blame", "--incremental", commit, "--", path)
+		try:
+			for chunk in text_chunks(chunks):
+				done = parser.feed(chunk)
+				if not done:
+					continue
+				entries += done
+				cells = [[e[2], self._blame_cell(e[0], parser.commits[e[0]])] for e in done if e[2] <= len(lines)]
+				yield "<script>blame({0});</script>".format(json.dumps(cells).replace("</", "<\\/"))
+		finally:
+			chunks.close()
+		entries.sort(key=lambda e: e[2])
+		if not self.blames is None and sum(e[3] for e in entries) == len(lines):
+			self.blames.put(f"{commit}:{path}", json.dumps({'commits': parser.commits, 'entries': entries}).encode("utf-8"))
+
+	def _raw_type(self, path, sha, size):
+		"""MIME type of the blob `sha` at `path`, from its name or else from its content"""
+		mime = mimetypes.guess_type(path)[0]
+		if mime is None and size <= self.max_highlight_size:
+			mime = "application/octet-stream" if is_binary(self.git.cat(sha)[2]) else "text/plain"
+		mime = mime or "application/octet-stream"
+		if mime.startswith("text/"):
+			mime += "; charset=utf-8"
+		return mime
+
+	def _log_page(self, path, start, n, prefetch=False):
+		"""`n` log entries from `start`, plus the first entry of the next page.
+		pages starting at a commit id are kept for a while, `prefetch` fills them in advance.
+		only what can't change is kept: dates and ref decorations are filled in when the page is shown"""
+		key = (path, start, n)
+		with self.log_pages_lock:
+			logs = self.log_pages.get(key)
+			if not logs is None:
+				self.log_pages.move_to_end(key)
+		if logs is None:
+			logs = self.git.log(path, ref=start, n=n+1, date="unix")
+			for l in logs:
+				l[5] = ""
+			if self.git.is_sha(start):
+				with self.log_pages_lock:
+					self.log_pages[key] = logs
+					while len(self.log_pages) > 64:
+						self.log_pages.popitem(last=False)
+		if prefetch:
 			return None
-		
-		if path!="":
-			dirs = [path+".."] + dirs
-		
-		txt_browse = "<h3>"+path+"</h3>"
-		txt_browse += "<ul>"
-		
-		for name in dirs:
-			name = name.replace(path,"")
-			txt_browse += "<li class='dir'><a href='/browse/{0}{1}'>{1}</a></li>".format(path,name)
-		
-		for name in files:
-			name = name.replace(path,"")
-			txt_browse += "<li class='file'><a href='/view/{0}{1}'>{1}</a></li>".format(path,name)
-		
-		txt_browse += "</ul>"
-		return (200, "text/html", self._tpl(txt_browse))
-	
-	def view(self, path):
-		ref = self.query.get('ref', [GIT.current_ref])[0]
-		path = path.strip("/")
+		decorations = self._decorations()
+		# rows are modified while rendering
+		return [l[:2] + [reltime(int(l[2]))] + l[3:5] + [decorations.get(l[6], "")] + l[6:] for l in logs]
+
+	def _prefetch_log_page(self, path, start, n):
 		try:
-			text = GIT.show(path, ref)
-			logs = GIT.log(path, ref, n=2)[-1]
+			self._log_page(path, start, n, prefetch=True)
 		except CalledProcessError:
 			logger.exception("git command error")
+
+	def _decorations(self):
+		"""commit id -> ' (master, tag: v1)', like `git log` %d"""
+		names = {}
+		for r in self.git.refs().values():
+			if r.name.startswith("refs/heads/"):
+				name = r.name[11:]
+			elif r.name.startswith("refs/tags/"):
+				name = "tag: " + r.name[10:]
+			else:
+				continue
+			names.setdefault(r.peeled, []).append(name)
+		return {sha: " ({0})".format(", ".join(n)) for sha, n in names.items()}
+
+	def _filtered_log(self, path, ref, start, n, filters):
+		"""`n` commits matching `filters` from `start`, plus the first of the next page, from the CommitIndex.
+		None if the index is not ready yet"""
+		index = self._ref_index(CommitIndex, "commits", ref, 2.0, self.indexer)
+		if index is None:
 			return None
-		
-		txt = "<h3>{0} <span class='ref'>@{1}</span></h3>".format(path, ref)
-		txt += "<p><a href='/history/{1}'>History</a> - Show diff: ".format(ref,path, logs[0])
-		
-		if ref!= logs[0]:
-			txt += "<a href='/diff/{1}?ref={2}..{0}'>previus</a> - ".format(ref,path, logs[0])
-		
-		txt += "<a href='/diff/{1}?ref={0}..HEAD'>HEAD</a></p>".format(ref,path, logs[0])
-		txt += self._hi(text, path)
-		
-		return (200, "text/html", self._tpl(txt))
-	
-	def history(self, path):
-		ref = self.query.get("ref", [None])[0]
+		# positions are only meaningful in the columns they come from
+		columns = index.columns
+		pos = None
+		if not start is None:
+			pos = index.position(self.git.rev(start), columns)
+			if pos is None:
+				return []
+		dates = {}
+		for k in ("since", "until"):
+			if filters.get(k):
+				try:
+					dates[k] = int(time.mktime(time.strptime(filters[k], "%Y-%m-%d")))
+				except ValueError:
+					pass
+		if "until" in dates:
+			# the whole day
+			dates["until"] += 86400
+		matches = index.matches(pos, author=filters.get("author"), message=filters.get("message"),
+			after=dates.get("since"), before=dates.get("until"), path=path if path not in ("", "/") else None, columns=columns)
+		decorations = self._decorations()
+		logs = []
+		for pos in islice(matches, n + 1):
+			row = index.row(pos, columns)
+			row[5] = decorations.get(row[6], "")
+			logs.append(row)
+		return logs
+
+	def history(self, ctx, path):
+		ref = ctx.query.get("ref", [None])[0]
+		start = ctx.query.get("s", [None])[0]
+		try:
+			n = min(max(int(ctx.query.get("n", [self.page_size])[0]), 1), 500)
+		except ValueError:
+			n = self.page_size
+		filters = {k: ctx.query[k][0].strip() for k in ("author", "message", "since", "until") if ctx.query.get(k, [""])[0].strip()}
 		try:
-			logs = GIT.log(path.strip("/"), ref=ref)
+			if filters:
+				logs = self._filtered_log(path.strip("/"), ref or ctx.current_ref, start, n, filters)
+			else:
+				logs = self._log_page(path.strip("/"), start or ref or ctx.current_ref, n)
 		except CalledProcessError:
 			logger.exception("git command error")
 			return None
+
+		form = "<form method='get' class='filters'>"
+		for k in ("author", "message"):
+			form += "<input name='{0}' value='{1}' placeholder='{0}'> ".format(k, html.escape(filters.get(k, ""), True))
+		for k in ("since", "until"):
+			form += "<input type='date' name='{0}' value='{1}' title='{0}'> ".format(k, html.escape(filters.get(k, ""), True))
+		if not ref is None:
+			form += "<input type='hidden' name='ref' value='{0}'>".format(html.escape(ref, True))
+		form += "<input type='submit' value='filter'></form>"
+
+		if logs is None:
+			if self._indexed_ref(ref or ctx.current_ref) is None:
+				return (400, "text/html", self._tpl(ctx, form + "<p>Filters only work on branches and tags.</p>"))
+			ctx.headers['Refresh'] = "2"
+			return (200, "text/html", self._tpl(ctx, form + "<p>Commit index is being built, this page will reload.</p>"))
+
+		next_start = None
+		if len(logs) > n:
+			# cursor is the first commit of the next page
+			next_start = logs[n][6]
+			logs = logs[:n]
+			if not filters:
+				self.prefetch.submit(self._prefetch_log_page, path.strip("/"), next_start, n)
 		
 		txt_h = f"<h3>History of {path} <span class='ref'>@{ref}</span></h3>"
-		txt_h += f"<form action='/diff/{path}' method='get'>"
+		txt_h += form
+		txt_h += f"<form action='{self.base}/diff/{path}' method='get'>"
 		txt_h += "<table class='logs'>"
 		txt_h += "<tr><th widht='20%'>author</th><th width='10%'>commit</th><th>message</th><th width='10%'>date</th>"
 		
@@ -486,10 +2807,10 @@ class GITServePages(object):
 			txt_h += "<td class='nw'>"
 			if self.use_gravatar:
 				l[4] = hashlib.md5(l[4].lower().encode()).hexdigest()
-				txt_h += "<img src='http://www.gravatar.com/avatar/{4}?s=16' width='16' height='16'>"
+				txt_h += "<img src='http://www.gravatar.com/avatar/{4}?s=16' width='16' height='16'>".format(*l)
 			txt_h += " {1}</td>".format(*l)
 			
-			txt_h += "<td class='nw'><a class='ref' href='/commit/{0}/'>{0}</a> {5}</td>".format(*l)
+			txt_h += "<td class='nw'><a class='ref' href='{base}/commit/{0}/'>{0}</a> {5}</td>".format(*l, base=self.base)
 			txt_h += "<td class='no'>{3}</td>".format(*l)
 			txt_h += "<td class='nw'>{2}</td>".format(*l)
 			
@@ -503,13 +2824,36 @@ class GITServePages(object):
 		if path!="/":
 			txt_h += "<div class='actions'><input type='submit' value='diff'></div>"
 
-		txt_h += "</form>"		
-		return (200, "text/html", self._tpl(txt_h))
+		txt_h += "</form>"
+
+		pages = []
+		query = {'n': n} if n != self.page_size else {}
+		query.update(filters)
+		if not ref is None:
+			query['ref'] = ref
+		if not start is None:
+			newest = "?" + urlencode(query) if query else ""
+			pages.append(f"<a href='{self.base}/history{path}{newest}'>newest</a>")
+		if not next_start is None:
+			pages.append(f"<a href='{self.base}/history{path}?{urlencode(dict(query, s=next_start))}'>older &raquo;</a>")
+		if pages:
+			txt_h += "<p class='pages'>" + " - ".join(pages) + "</p>"
+		return (200, "text/html", self._tpl(ctx, txt_h))
 		
-	def commit(self, ref):
+	def commit(self, ctx, ref):
+		try:
+			sha = self.git.rev(ref)
+		except CalledProcessError:
+			logger.exception("git command error")
+			return None
+		return self._cached(ctx, ("commit", ref, sha), partial(self._commit, ctx, sha, ref))
+
+	def _commit(self, ctx, sha, ref):
 		try:
-			files = GIT.diff_tree(ref)
-			log = GIT.log(ref=ref, n=1)[0]
+			log = self.git.log(ref=sha, n=1, date="iso")[0]
+			parent = self.git.resolve(f"{sha}^")
+			parent = self.git.empty_tree() if parent is None else parent[0]
+			files = self._diff_files(parent, sha)
 		except CalledProcessError:
 			logger.exception("git command error")
 			return None
@@ -522,74 +2866,215 @@ class GITServePages(object):
 			txt += "<p>{1} - {2}</p>"
 		txt += "<pre>{3}</pre>"
 		txt = txt.format(*log)
+		txt += "<p>Download: <a href='{1}/archive/{0}.tar.gz'>tar.gz</a> - <a href='{1}/archive/{0}.zip'>zip</a></p>".format(sha, self.base)
 		
-		txt += "<ul>"
-		for f in files:
-			txt += "<li><b>{1}</b> <a href='/view/{2}?ref={0}'>{2}</a></li>".format(ref, *f)
-		txt += "</ul>"
-		
-		return (200, "text/html", self._tpl(txt))
+		txt += files
+		return (200, "text/html", self._tpl(ctx, txt))
 
-	def diff(self,path):
-		ref = self.query.get("ref", [None])[0]
+	def diff(self, ctx, path):
+		ref = ctx.query.get("ref", [None])[0]
 		if not ref is None and ".." in ref:
 			ref1, ref2 = ref.split("..")
 		else:
 			ref1, ref2 = ref, None
 		
-		ref1 = self.query.get("ref1", [ref1])[0]
-		ref2 = self.query.get("ref2", [ref2])[0]
+		ref1 = ctx.query.get("ref1", [ref1])[0]
+		ref2 = ctx.query.get("ref2", [ref2])[0]
 		
-		ref1 = ref1 or GIT.current_ref
+		ref1 = ref1 or ctx.current_ref
 		ref2 = ref2 or f"{ref1}~1"		
 		
 		path = path.strip("/")
+		immutable = self.git.is_sha(ref1) and self.git.is_sha(ref2)
+		try:
+			ref1 = self._diff_side(ref1)
+			ref2 = self._diff_side(ref2)
+		except CalledProcessError:
+			logger.exception("git command error")
+			return None
+		if ctx.query.get("fragment"):
+			return self._cached(ctx, ("diff-fragment", path, ref1, ref2), partial(self._diff_fragment, path, ref1, ref2), immutable)
+		return self._cached(ctx, ("diff", path, ref1, ref2), partial(self._diff, ctx, path, ref1, ref2))
+
+	def _diff_side(self, ref):
+		"""full id of commit `ref`, or of tree `ref` if it's a tree, like the empty tree root commits are compared to"""
+		r = self.git.resolve(ref)
+		if not r is None and r[1] == "tree":
+			return r[0]
+		return self.git.rev(ref)
+
+	def _diff(self, ctx, path, ref1, ref2):
 		logs=[]
 		try:
-			text, dref1, dref2 = GIT.diff(path, ref1, ref2)
-			# refs from diff are None when there is no diff.
-			ref1 = dref1 or ref1
-			ref2 = dref2 or ref2
-			logs.append(GIT.log(path, ref1, n=1)[0])
-			logs.append(GIT.log(path, ref2, n=1)[0])
+			files = self._diff_files(ref1, ref2, path)
+			# a side is missing if the path did not exist there
+			for ref in (ref1, ref2):
+				if self.git.resolve(ref)[1] == "commit":
+					logs += self.git.log(path, ref, n=1, date="iso")
 		except CalledProcessError:
 			logger.exception("git command error")
 			return None
 
-		txt = f"<h3>Diff <span class='ref'>{ref1}</span>..<span class='ref'>{ref2}</span> -- {path}</h3>"
-		if text is None:
+		txt = f"<h3>Diff <span class='ref'>{self.git.short(ref1)}</span>..<span class='ref'>{self.git.short(ref2)}</span> -- {path}</h3>"
+		if files == "":
 			txt += "<p>Files are identical!</p>"
-		else:
-			for l in logs:
+			return (200, "text/html", self._tpl(ctx, txt))
 
-				txt += "<dl>"
-				txt += "<dt><a class='ref' href='/commit/{0}/'>{0}</a> - "
-				if self.use_gravatar:
-					l[4]=hashlib.md5( l[4].lower().encode() ).hexdigest()
-					txt = "<img src='http://www.gravatar.com/avatar/{4}?s=16'>  "
-				txt += "{1} - {2}</dt>"
-				txt += "<dd><pre>{3}</pre></dd>"
-				txt += "</dl>"
-				txt = txt.format(*l)
-				
-			txt += self._hi(text, "diff.patch")
-		
-		return (200, "text/html", self._tpl(txt))
+		for l in logs:
+			dl = "<dl>"
+			dl += "<dt><a class='ref' href='{base}/commit/{0}/'>{0}</a> - "
+			if self.use_gravatar:
+				l[4]=hashlib.md5( l[4].lower().encode() ).hexdigest()
+				dl += "<img src='http://www.gravatar.com/avatar/{4}?s=16'>  "
+			dl += "{1} - {2}</dt>"
+			dl += "<dd><pre>{3}</pre></dd>"
+			dl += "</dl>"
+			txt += dl.format(*l, base=self.base)
+
+		txt += files
+		return (200, "text/html", self._tpl(ctx, txt))
+
+	def _diff_files(self, ref1, ref2, path=""):
+		"""html of the diffstat and of the diff of each file between `ref1` and `ref2`, "" if there are no changes.
+		files over the line limits are left out, with a link to load them"""
+		files = self.git.numstat(path, ref1, ref2)
+		if not files:
+			return ""
+		shown = set()
+		total = 0
+		for n, (added, deleted, name) in enumerate(files):
+			if added is None:
+				continue
+			lines = added + deleted
+			if lines <= self.max_diff_file_lines and total + lines <= self.max_diff_lines:
+				shown.add(n)
+				total += lines
+		diffs = {}
+		if shown:
+			chunks = self.git.diff(path, ref1, ref2)
+			try:
+				diffs = dict(split_diff(chunks, shown, self.max_highlight_size))
+			finally:
+				chunks.close()
+
+		txt = "<table class='diffstat'>"
+		for n, (added, deleted, name) in enumerate(files):
+			if added is None:
+				num = "binary"
+			else:
+				num = f"<span class='added'>+{added}</span> <span class='deleted'>-{deleted}</span>"
+			txt += "<tr><td class='num'>{0}</td><td><a href='#file-{1}'>{2}</a></td></tr>".format(num, n, html.escape(name))
+		txt += "</table>"
+		txt += "<p>{0} file{1} changed, {2} insertions(+), {3} deletions(-)</p>".format(
+			len(files), "" if len(files) == 1 else "s", sum(f[0] or 0 for f in files), sum(f[1] or 0 for f in files))
+
+		lazy = False
+		for n, (added, deleted, name) in enumerate(files):
+			link = "{0}/diff/{1}?ref={2}..{3}".format(self.base, html.escape(quote(name), True), html.escape(ref1, True), html.escape(ref2, True))
+			txt += "<div class='file' id='file-{0}'><h4><a href='{1}'>{2}</a></h4>".format(n, link, html.escape(name))
+			text = diffs.get(n)
+			if added is None:
+				txt += "<p>Binary file.</p>"
+			elif text is None or len(text) > self.max_highlight_size:
+				lazy = True
+				txt += "<p class='lazy'>{0} changed lines are not shown. <a class='load' href='{1}&amp;fragment=1'>Load the diff</a></p>".format(added + deleted, link)
+			else:
+				txt += self._hi(text, "diff.patch")
+			txt += "</div>"
+		if lazy:
+			txt += """<script>
+				document.querySelectorAll("a.load").forEach(function(a) {
+					a.onclick = function(e) {
+						e.preventDefault();
+						a.textContent = "Loading...";
+						fetch(a.href).then(function(r) { return r.text(); }).then(function(t) { a.parentNode.outerHTML = t; });
+					};
+				});
+			</script>"""
+		return txt
+
+	def _diff_fragment(self, path, ref1, ref2):
+		"""the highlighted diff of a single file, without the page around it"""
+		try:
+			chunks = text_chunks(self.git.diff(path, ref1, ref2))
+			# read up to the highlight limit, to know if the diff is small
+			text = ""
+			for chunk in chunks:
+				text += chunk
+				if len(text) > self.max_highlight_size:
+					break
+		except CalledProcessError:
+			logger.exception("git command error")
+			return None
+		if len(text) <= self.max_highlight_size:
+			return (200, "text/html", self._hi(text, "diff.patch"))
+		# big diff, stream it
+		return (200, "text/html", self._hi_stream(chain([text], chunks), "diff.patch"))
+
+	def search(self, ctx):
+		q = ctx.query.get("q", [""])[0]
+		use_re = ctx.query.get("re", ["0"])[0] == "1"
+		icase = ctx.query.get("i", ["0"])[0] == "1"
+		ref = ctx.query.get("ref", [ctx.current_ref])[0]
+
+		txt = """<form method='get'><input name='q' value='{0}' size='40' placeholder='search code' autofocus>
+			<label><input type='checkbox' name='re' value='1'{1}> regex</label>
+			<label><input type='checkbox' name='i' value='1'{2}> ignore case</label>
+			<input type='hidden' name='ref' value='{3}'>
+			<input type='submit' value='search'></form>""".format(
+			html.escape(q, True), " checked" if use_re else "", " checked" if icase else "", html.escape(ref, True))
+		if q == "":
+			return (200, "text/html", self._tpl(ctx, txt, title="search"))
 
-	def wiki(self, path):
+		try:
+			regex = re.compile(q if use_re else re.escape(q), re.I if icase else 0)
+		except re.error as e:
+			return (400, "text/html", self._tpl(ctx, txt + f"<p>Invalid regex: {html.escape(str(e))}</p>", title="search"))
+
+		index = self._search_index(ref)
+		if index is None:
+			if self._indexed_ref(ref) is None:
+				return (400, "text/html", self._tpl(ctx, txt + "<p>Search only works on branches and tags.</p>", title="search"))
+			ctx.headers['Refresh'] = "2"
+			return (200, "text/html", self._tpl(ctx, txt + "<p>Search index is being built, this page will reload.</p>", title="search"))
+
+		literals = index.literals(q) if use_re else [q]
+		if icase:
+			# the index only folds the case of ascii letters
+			literals = [l for l in literals if l.isascii()]
+		results = ""
+		count = 0
+		for paths, lines in index.search(regex, literals):
+			if paths is None:
+				results += "<p>The search stopped before the end of the files, use a longer text to narrow it down.</p>"
+				break
+			count += 1
+			if count > index.max_results:
+				results += f"<p>Only the first {index.max_results} files are shown.</p>"
+				break
+			links = ", ".join("<a href='{3}/view/{0}?ref={1}'>{2}</a>".format(html.escape(p, True), html.escape(ref, True), html.escape(p), self.base) for p in paths)
+			results += f"<h3>{links}</h3><table class='search'>"
+			for n, snippet in lines:
+				results += f"<tr><td class='ln'>{n}</td><td><code>{snippet}</code></td></tr>"
+			results += "</table>"
+		if count == 0:
+			results = "<p>No matches.</p>" + results
+		return (200, "text/html", self._tpl(ctx, txt + results, title="search"))
+
+	def wiki(self, ctx, path):
 		path = path.strip("/")
-		branches = GIT.branch()
+		branches = self.git.branch()
 		
 		if not self.use_md:
-			return (200, "text/html", self._tpl("Markdown support is required to use wiki."))
+			return (200, "text/html", self._tpl(ctx, "Markdown support is required to use wiki."))
 		
 		create = False
 		if "__wiki" not in branches:
-			if self.method == "POST":
-				create = int(self.post.get('create',['0'])[0]) == 1
+			if ctx.method == "POST":
+				create = int(ctx.post.get('create',['0'])[0]) == 1
 				# to create a wiki, we need to create an empty branch called "__wiki" and add commit to it
 				# we add an empty home.md file
-				self.post['text'] = ["# Your new wiki home\nEdit this page, use markdown syntax",]
+				ctx.post['text'] = ["# Your new wiki home\nEdit this page, use markdown syntax",]
 				path = "home"
 			else:
 				form = """
@@ -598,78 +3083,48 @@ class GITServePages(object):
 				</form>
 				<p><b>WARNING!</b> Wiki function is experimental!</p>
 				"""
-				return (200, "text/html", self._tpl(form))
+				return (200, "text/html", self._tpl(ctx, form))
 		
 		if path == "":
 			path = "home"
 		fpath = f"{path}.md"
 
-		wikiGitDo = partial(GIT._do, f"--work-tree={self.tmpdir}")
-				
 		# handle POST
-		if self.method == "POST":
-			text = self.post.get("text",[None])[0]
-			action = self.post.get("action",["save"])[0]
+		if ctx.method == "POST":
+			text = ctx.post.get("text",[None])[0]
+			action = ctx.post.get("action",["save"])[0]
 
 			if not text is None:
-				orig_branch = GIT.branch_current()
-				try:
+				if action == "save":
 					if create:
-						r = wikiGitDo("checkout", "--orphan", "__wiki")
+						msg = "Created new wiki"
 					else:
-						r = wikiGitDo("checkout", "__wiki")
-				except CalledProcessError as e:
-					return (500, "text/html", self._tpl(f"<pre>{e.output}</pre>", title="wiki"))
-	
-				if action == "save":
-					try:
-						with open(os.path.join(self.tmpdir, fpath), "w") as f:
-							r = f.write(text)
-					except Exception as e:
-						r = wikiGitDo("checkout", fpath)
-						r = wikiGitDo("checkout", orig_branch)
-						return (500, "text/html", self._tpl(f"I'm sorry. Something went wrong saving the page. <pre>{e.message}</pre>", title="wiki"))
-
-					try:
-						r = wikiGitDo("add" , fpath)
-					except CalledProcessError as e:
-						return (500, "text/html", self._tpl(f"<pre>{e.output}</pre>", title="wiki"))
-					
-					try:
-						if create:
-							msg = "Created new wiki"
-						else:
-							msg = f"Modified {path}"
-						r = wikiGitDo("commit" , "-m", msg)
-					except CalledProcessError as e:
-						return (500, "text/html", self._tpl(f"<pre>{e.output}</pre>", title="wiki"))
-				
+						msg = f"Modified {path}"
 				elif action == "delete":
-					try:
-						msg = f"Deleted {path}"
-						r = wikiGitDo("rm", fpath)
-						r = wikiGitDo("commit", "-m", msg)
-					except CalledProcessError as e:
-						return (500, "text/html", self._tpl(f"<pre>{e.output}</pre>", title="wiki"))
-										
-					path = "home"
+					msg = f"Deleted {path}"
+					text = None
+				else:
+					return (400, "text/html", self._tpl(ctx, f"Unknown action '{html.escape(action)}'", title="wiki"))
 
 				try:
-					r = wikiGitDo("checkout", orig_branch)
+					self.git.commit_file("__wiki", fpath, text, msg)
 				except CalledProcessError as e:
-					return (500, "text/html", self._tpl(f"<pre>{e.output}</pre>", title="wiki"))
+					return (500, "text/html", self._tpl(ctx, f"<pre>{html.escape(e.output or str(e))}</pre>", title="wiki"))
+
+				if action == "delete":
+					path = "home"
 				
-			return (302, '', u'/wiki/{0}'.format(path))
+			return (302, '', u'{1}/wiki/{0}'.format(path, self.base))
 			# end of POST
 		
 		# handle GET
-		log = GIT.log(fpath, ref="__wiki", n=1)
+		log = self.git.log(fpath, ref="__wiki", n=1)
 		if len(log) == 0:
 			text = "_new page_"
 			log = ['','','','','']
 		else:
 			try:
-				text = GIT.show(fpath, ref="__wiki")
+				text = self.git.show(fpath, ref="__wiki")
 			except CalledProcessError as e:
 				if e.returncode == 128:
 					text = "_new page_"
@@ -679,7 +3134,7 @@ class GITServePages(object):
 			else:
 				log = log[0]
 
-		if "edit" in self.query:
+		if "edit" in ctx.query:
 			text = f"""
 				<header>
 					<h3>{path}</h3> 
@@ -692,21 +3147,239 @@ class GITServePages(object):
 				</div>
 			"""
 		else:
-			text = markdown.markdown(text)
+			with metrics.timer("git_serve_step_duration_seconds", (("step", "markdown"),)):
+				text = markdown.markdown(text)
 			logtext = ""
 			if log[0] != '':
-				logtext = "<a class='ref' href='/commit/{0}/'>{2}</a> by {1} - <a href='/history/{fpath}?ref=__wiki'>history</a> - ".format(*log, fpath=fpath)
+				logtext = "<a class='ref' href='{base}/commit/{0}/'>{2}</a> by {1} - <a href='{base}/history/{fpath}?ref=__wiki'>history</a> - ".format(*log, fpath=fpath, base=self.base)
 			text = f"""
 				<header>
 					<h3>{path}</h3> 
-					<small>{logtext}<a href='/wiki/{path}?edit=1'>edit</a></small>
+					<small>{logtext}<a href='{self.base}/wiki/{path}?edit=1'>edit</a></small>
 				</header>
 				<div>{text}</div>
 			"""
 			
-		return (200, "text/html", self._tpl(text, title="wiki"))
+		return (200, "text/html", self._tpl(ctx, text, title="wiki"))
+
+class GITRepo(object):
+	""" A served repository and its state: git class, pages and pack cache """
+	def __init__(self, name, path, git, pages, pack_cache=None):
+		self.name = name
+		self.path = path
+		self.git = git
+		self.pages = pages
+		self.pack_cache = pack_cache
+		self.vfolder = f"/{name}"
+		# requests being served, and when the last one ended
+		self.active = 0
+		self.last_used = time.monotonic()
+
+	def close(self):
+		self.pages.close()
+		self.git.close()
+
+
+class GITRepos(object):
+	""" The repositories found below a directory, served from one process.
+	The state of a repository is created by the first request to it and dropped
+	after `idle_timeout` seconds without requests """
+	rescan_interval = 10
+
+	def __init__(self, root, options, idle_timeout=600):
+		self.root = root
+		self.options = options
+		self.idle_timeout = idle_timeout
+		self.lock = threading.Lock()
+		self.repos = {}
+		self._names = []
+		self._scanned = None
+		self.highlight_cache = None
+		if options.get('highlight_cache_size', 256 << 20):
+			cache_dir = options.get('cache_dir') or default_cache_dir()
+			self.highlight_cache = DiskCache(os.path.join(cache_dir, "highlight"), options.get('highlight_cache_size', 256 << 20), "highlight")
+		reaper = threading.Thread(target=self._reap, name="git-serve-reaper", daemon=True)
+		reaper.start()
+
+	@staticmethod
+	def is_repo(path):
+		"""True if `path` is a work tree or a bare repository"""
+		if os.path.exists(os.path.join(path, ".git")):
+			return True
+		return os.path.isfile(os.path.join(path, "HEAD")) and os.path.isdir(os.path.join(path, "objects")) and os.path.isdir(os.path.join(path, "refs"))
+
+	def names(self):
+		"""names of the repositories, relative paths from the root. rescanned every few seconds"""
+		now = time.monotonic()
+		if self._scanned is None or now - self._scanned > self.rescan_interval:
+			names = []
+			for dirpath, dirnames, filenames in os.walk(self.root):
+				dirnames.sort()
+				if dirpath != self.root and self.is_repo(dirpath):
+					names.append(os.path.relpath(dirpath, self.root).replace(os.path.sep, "/"))
+					# no nested repositories
+					dirnames[:] = []
+				else:
+					dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+			self._names, self._scanned = names, now
+		return self._names
+
+	def find(self, path):
+		"""name of the repository url `path` points into, or None"""
+		parts = path.partition("?")[0].strip("/").split("/")
+		names = set(self.names())
+		for i in range(len(parts), 0, -1):
+			name = "/".join(parts[:i])
+			if name in names:
+				return name
+		return None
+
+	def acquire(self, name):
+		"""the GITRepo named `name`, created if needed. must be given back with `release`"""
+		with self.lock:
+			repo = self.repos.get(name)
+			if not repo is None:
+				repo.active += 1
+				return repo
+		# creating it runs git, don't hold back the requests to the other repositories
+		path = os.path.join(self.root, name)
+		git = GIT.for_repo(path)
+		pages = GITServePages(self.options, git, f"/{name}", self.highlight_cache)
+		pack_cache = None
+		if self.options.get('pack_cache_size'):
+			pack_cache = PackCache(os.path.join(pages.repo_cache_dir, "packs"), self.options['pack_cache_size'], git)
+		new = GITRepo(name, path, git, pages, pack_cache)
+		with self.lock:
+			repo = self.repos.setdefault(name, new)
+			repo.active += 1
+		if not repo is new:
+			# another request created it first
+			new.close()
+		return repo
+
+	def release(self, repo):
+		with self.lock:
+			repo.active -= 1
+			repo.last_used = time.monotonic()
+
+	def evict(self, idle_timeout=None):
+		"""drop the state of the repositories idle for more than `idle_timeout` seconds"""
+		if idle_timeout is None:
+			idle_timeout = self.idle_timeout
+		now = time.monotonic()
+		with self.lock:
+			idle = [r for r in self.repos.values() if r.active == 0 and now - r.last_used >= idle_timeout]
+			for repo in idle:
+				del self.repos[repo.name]
+		for repo in idle:
+			repo.close()
+
+	def _reap(self):
+		while True:
+			time.sleep(max(self.idle_timeout / 4, 1))
+			try:
+				self.evict()
+			except Exception:
+				logger.exception("error evicting idle repositories")
+
+	def index(self):
+		"""the page listing the repositories"""
+		txt = ""
+		for name in self.names():
+			state = " <small>(active)</small>" if name in self.repos else ""
+			txt += "<li><a href='/{0}/'>{1}</a>{2}</li>".format(html.escape(name, True), html.escape(name), state)
+		if txt == "":
+			txt = "<p>No repositories found.</p>"
+		else:
+			txt = f"<ul class='repos'>{txt}</ul>"
+		return f"""<!DOCTYPE html>
+			<head>
+				<meta charset="UTF-8">
+				<title>{html.escape(os.path.basename(self.root))}</title>
+				<style>{GITServePages.style}</style>
+			</head>
+			<body>
+				<header><nav><strong>~{html.escape(os.path.basename(self.root))}</strong></nav></header>
+				<article><h3>Repositories</h3>{txt}</article>
+			</body>
+		"""
+
+
+def render_page(pages, request):
+	"""run the controller of `pages` for `request`.
+	returns (route, result, headers, encodings), result is None if no route matches"""
+	ctx = None
+	try:
+		ctx = GITRequestContext(request)
+		r = pages.route(ctx)
+		return ctx.route, r, ctx.headers, ctx.encodings
+	except Exception as e:
+		tb = "".join(traceback.format_exception(*sys.exc_info()))
+		errmsg = f"""<!DOCTYPE html>
+			<style>
+				body{{
+					font-family: sans-serif;
+					background-color: #EEE;
+					color: #888;
+				}}
+			</style>
+			<body>
+			<h1>Server Error</h1>
+			<pre>{tb}</pre>
+		"""
+		return ("error" if ctx is None else ctx.route), (500, "text/html", errmsg), {}, []
+
+
+def page_response(r, headers, encodings, min_compress_size=1024):
+	"""(code, headers, body) to send for the result `r` of a controller, that set `headers`.
+	the body is bytes, or an iterator of chunks to be sent chunked unless the headers have its length"""
+	code, mime, body = r
+	if code == 302:
+		return code, list(headers.items()) + [('Location', body), ('Content-Length', 0)], b""
+	out = list(headers.items())
+	if code == 304:
+		return code, out, b""
+	# pages show the ref chosen with a cookie
+	out += [('Content-type', mime), ('Vary', 'Accept-Encoding, Cookie')]
+	if isinstance(body, str):
+		body = body.encode("utf-8")
+	if isinstance(body, bytes):
+		if not 'Content-Encoding' in headers and encodings and len(body) >= min_compress_size:
+			body = compress(body, encodings[0])
+			out.append(('Content-Encoding', encodings[0]))
+		out.append(('Content-Length', len(body)))
+	elif not 'Content-Length' in headers and "gzip" in encodings and mime.startswith("text/"):
+		body = gzip_stream(body)
+		out.append(('Content-Encoding', 'gzip'))
+	return code, out, body
+
+
+def count_pack_bytes(chunks, cached):
+	"""pass `chunks` of an upload-pack response through, counting them in the metrics"""
+	size = 0
+	try:
+		for chunk in chunks:
+			size += len(chunk)
+			yield chunk
+	finally:
+		metrics.inc("git_serve_upload_pack_bytes_total", (("cached", cached),), size)
+
 
 class GITRequestHandler(CGIHTTPRequestHandler):
+	# needed for chunked responses. connections are still closed after each
+	# request, to not hold a worker thread while idle
+	protocol_version = "HTTP/1.1"
+	pack_cache = None
+	# bigger upload-pack requests are not looked up in the pack cache
+	max_pack_request = 1 << 20
+	# GITRepos in multi-repository mode, the attributes of the repository are then set per request
+	repos = None
+	# path of the repository below GIT_PROJECT_ROOT, for git-http-backend
+	backend_prefix = ""
+	# route and status code of the request, for metrics
+	route = "other"
+	status = None
+
 	def translate_path(self, path):
 		if path.startswith(self.repo_vfolder):
 			r = GIT_HTTP_BACKEND
@@ -718,87 +3391,855 @@ class GITRequestHandler(CGIHTTPRequestHandler):
 		is_cgi = CGIHTTPRequestHandler.is_cgi(self)
 		if is_cgi and self.path.startswith(self.repo_vfolder):
 			head, tail = self.cgi_info 
-			self.cgi_info = head, f"{GIT_HTTP_BACKEND_NAME}/{tail}"
+			self.cgi_info = head, f"{GIT_HTTP_BACKEND_NAME}{self.backend_prefix}/{tail}"
 		return is_cgi
 	
 	def _do_pages(self):
-		try:
-			r = self.pages.route(self)
-		except Exception as e:
-			tb = "".join(traceback.format_exception(*sys.exc_info()))
-			errmsg = f"""<!DOCTYPE html>
-				<style>
-					body{{
-						font-family: sans-serif;
-						background-color: #EEE;
-						color: #888;
-					}}
-				</style>
-				<body>
-				<h1>Server Error</h1>
-				<pre>{tb}</pre>
-			"""
-			r = (500, "text/html", errmsg)
-		
-		if not r is None:
-			self.send_response(r[0])
-			if r[0] == 302:
-				self.send_header('Location', r[2])
-				return False
-			self.send_header('Content-type',r[1])
-			self.send_header('Accept-Ranges', 'bytes')
-			self.send_header('Content-Length', len(r[2]))
+		route, r, headers, encodings = render_page(self.pages, self)
+		if r is None:
+			return False
+		self.route = route
+		with metrics.timer("git_serve_step_duration_seconds", (("step", "send"),)):
+			self._send_page(r, headers, encodings)
+		return True
+
+	def _send_page(self, r, headers, encodings):
+		"""send the response of a controller"""
+		code, headers, body = page_response(r, headers, encodings, self.pages.min_compress_size)
+		self.send_response(code)
+		self.send_header('Connection', 'close')
+		for k, v in headers:
+			self.send_header(k, v)
+		if isinstance(body, bytes):
 			self.end_headers()
-			self.wfile.write(r[2].encode("utf-8"))
+			self.wfile.write(body)
+		else:
+			self._send_stream(body, chunked=not 'Content-Length' in dict(headers))
+
+	def _send_stream(self, chunks, chunked=True):
+		"""send a body given as chunks of str or bytes, as they are produced.
+		with `chunked` false the length must be in the headers already"""
+		chunked = chunked and self.request_version >= "HTTP/1.1"
+		if chunked:
+			self.send_header('Transfer-Encoding', 'chunked')
+		self.end_headers()
+		try:
+			for chunk in chunks:
+				if isinstance(chunk, str):
+					chunk = chunk.encode("utf-8")
+				if not chunk:
+					continue
+				if chunked:
+					self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+				else:
+					self.wfile.write(chunk)
+			if chunked:
+				self.wfile.write(b"0\r\n\r\n")
+		except (BrokenPipeError, ConnectionResetError):
+			pass
+		except Exception:
+			# headers are gone already, all we can do is to cut the response short
+			logger.exception("error streaming response")
+		finally:
+			if hasattr(chunks, "close"):
+				chunks.close()
+
+	def run_cgi(self):
+		# cgi scripts output has no length, the connection end marks its end
+		self.close_connection = True
+		self.route = "cgi"
+		CGIHTTPRequestHandler.run_cgi(self)
+
+	def _do_git(self):
+		"""smart http transport for clone and fetch. everything else goes to git-http-backend"""
+		path, _, query = self.path.partition("?")
+		if not path.startswith(self.repo_vfolder + "/"):
+			return False
+		service = path[len(self.repo_vfolder):]
+		if self.command == "GET" and service == "/info/refs" and parse_qs(query).get('service') == ["git-upload-pack"]:
+			self.route = "info_refs"
+			self._upload_pack(advertise=True)
+			return True
+		if self.command == "POST" and service == "/git-upload-pack":
+			self.route = "upload_pack"
+			self._upload_pack(advertise=False)
 			return True
 		return False
-			
+
+	def _upload_pack(self, advertise):
+		env = dict(os.environ)
+		protocol = self.headers.get('Git-Protocol') or ""
+		if protocol:
+			env['GIT_PROTOCOL'] = protocol
+
+		request = iter(())
+		key = None
+		if not advertise:
+			request = self._request_data()
+			if not self.pack_cache is None:
+				head = b""
+				for chunk in request:
+					head += chunk
+					if len(head) > self.max_pack_request:
+						break
+				else:
+					key = self.pack_cache.key(head, protocol)
+				request = chain([head], request)
+
+		self.send_response(200)
+		self.send_header('Connection', 'close')
+		self.send_header('Content-Type', 'application/x-git-upload-pack-{0}'.format("advertisement" if advertise else "result"))
+		self.send_header('Cache-Control', 'no-cache')
+
+		tee = None
+		if not key is None:
+			f = self.pack_cache.open(key)
+			if not f is None:
+				with f:
+					self._send_stream(count_pack_bytes(iter(partial(f.read, 1 << 16), b""), "true"))
+				return
+			tee = self.pack_cache.start(key)
+
+		out = None
+		if not tee is None:
+			# keep a copy of the response for the next identical request
+			out = os.fdopen(tee[0], "wb")
+		ok = False
+		try:
+			cmd = ['git', 'upload-pack', '--stateless-rpc']
+			if advertise:
+				cmd.append('--advertise-refs')
+			cmd.append(self.repo_path)
+			start = time.perf_counter()
+			proc = Popen(cmd, stdin=DEVNULL if advertise else PIPE, stdout=PIPE, env=env)
+
+			feeder = None
+			if not advertise:
+				feeder = threading.Thread(target=self._feed, args=(proc.stdin, request), daemon=True)
+				feeder.start()
+
+			def output():
+				nonlocal ok
+				if advertise and not "version=2" in protocol:
+					yield pkt_line(b"# service=git-upload-pack\n") + b"0000"
+				while True:
+					chunk = proc.stdout.read1(1 << 16)
+					if not chunk:
+						break
+					if not out is None:
+						out.write(chunk)
+					yield chunk
+				ok = proc.wait() == 0
+
+			try:
+				self._send_stream(count_pack_bytes(output(), "false"))
+			finally:
+				proc.stdout.close()
+				if proc.poll() is None:
+					proc.kill()
+				proc.wait()
+				metrics.observe("git_serve_git_duration_seconds", (("command", "upload-pack"),), time.perf_counter() - start)
+				if not feeder is None:
+					feeder.join()
+		finally:
+			# also when the client left before the response started
+			if not out is None:
+				out.close()
+				self.pack_cache.finish(key, tee[1], ok)
+
+	def _request_body(self, chunk_size=1 << 16):
+		"""yields the request body in chunks of bytes, as it arrives"""
+		if self.headers.get('Transfer-Encoding', "").lower() == "chunked":
+			while True:
+				size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+				if size == 0:
+					# skip trailers
+					while self.rfile.readline().strip() != b"":
+						pass
+					return
+				while size > 0:
+					data = self.rfile.read(min(size, chunk_size))
+					if not data:
+						return
+					size -= len(data)
+					yield data
+				self.rfile.readline()
+		else:
+			remaining = int(self.headers.get('Content-Length') or 0)
+			while remaining > 0:
+				data = self.rfile.read(min(remaining, chunk_size))
+				if not data:
+					return
+				remaining -= len(data)
+				yield data
+
+	def _request_data(self, chunk_size=1 << 16):
+		"""yields the request body in chunks of bytes, decompressing it if it's gzipped"""
+		if not self.headers.get('Content-Encoding', "").lower() in ("gzip", "x-gzip"):
+			yield from self._request_body(chunk_size)
+			return
+		decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		for data in self._request_body(chunk_size):
+			data = decoder.decompress(data, chunk_size)
+			while data:
+				yield data
+				data = decoder.decompress(decoder.unconsumed_tail, chunk_size)
+		yield decoder.flush()
+
+	def _feed(self, stdin, chunks):
+		"""copy `chunks` of the request body to `stdin`"""
+		try:
+			for data in chunks:
+				stdin.write(data)
+		except (OSError, ValueError, zlib.error):
+			logger.exception("error reading request body")
+		finally:
+			try:
+				stdin.close()
+			except OSError:
+				pass
+
+	def _serve(self):
+		self._do_git() or self._do_pages() or CGIHTTPRequestHandler.do_GET(self)
+
+	def _serve_repos(self):
+		"""serve the request with the state of the repository it points into"""
+		path = self.path.partition("?")[0]
+		name = self.repos.find(path)
+		if name is None:
+			if self.command == "GET" and path == "/":
+				self.route = "repos"
+				body = self.repos.index().encode("utf-8")
+				self.send_response(200)
+				self.send_header('Content-type', "text/html")
+				self.send_header('Content-Length', len(body))
+				self.end_headers()
+				self.wfile.write(body)
+			else:
+				self.send_error(404)
+			return
+		if path == f"/{name}":
+			self.send_response(301)
+			self.send_header('Location', f"/{name}/")
+			self.send_header('Content-Length', 0)
+			self.end_headers()
+			return
+		repo = self.repos.acquire(name)
+		try:
+			self.repo_name = repo.name
+			self.repo_path = repo.path
+			self.repo_vfolder = repo.vfolder
+			self.backend_prefix = repo.vfolder
+			self.cgi_directories = [repo.vfolder]
+			self.pages = repo.pages
+			self.pack_cache = repo.pack_cache
+			self._serve()
+		finally:
+			self.repos.release(repo)
+
+	def send_response(self, code, message=None):
+		self.status = code
+		CGIHTTPRequestHandler.send_response(self, code, message)
+
+	def _do_metrics(self):
+		self.route = "metrics"
+		body = metrics.render().encode("utf-8")
+		self.send_response(200)
+		self.send_header('Content-type', "text/plain; version=0.0.4")
+		self.send_header('Content-Length', len(body))
+		self.end_headers()
+		self.wfile.write(body)
+
 	def do_GET(self):
-		self._do_pages() or CGIHTTPRequestHandler.do_GET(self)
+		self.close_connection = True
+		start = time.perf_counter()
+		metrics.inc("git_serve_requests_in_flight", (), 1)
+		try:
+			if self.command == "GET" and self.path == "/metrics":
+				self._do_metrics()
+			elif self.repos is None:
+				self._serve()
+			else:
+				self._serve_repos()
+		finally:
+			metrics.inc("git_serve_requests_in_flight", (), -1)
+			metrics.inc("git_serve_requests_total", (("route", self.route), ("code", str(self.status))))
+			metrics.observe("git_serve_request_duration_seconds", (("route", self.route),), time.perf_counter() - start)
 
 	def do_POST(self):
-		self._do_pages() or CGIHTTPRequestHandler.do_GET(self)
+		self.do_GET()
+
+
+class GITHTTPServer(HTTPServer):
+	"""HTTPServer handling requests on a bounded pool of worker threads"""
+	def __init__(self, server_address, handler, workers=1):
+		HTTPServer.__init__(self, server_address, handler)
+		self.workers = workers
+		self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="git-serve")
+
+	def process_request(self, request, client_address):
+		self.executor.submit(self.process_request_thread, request, client_address)
+
+	def process_request_thread(self, request, client_address):
+		try:
+			self.finish_request(request, client_address)
+		except Exception:
+			self.handle_error(request, client_address)
+		finally:
+			self.shutdown_request(request)
+
+	def server_close(self):
+		HTTPServer.server_close(self)
+		self.executor.shutdown(wait=False)
+
+
+class GITAsyncRequest(object):
+	""" What the pages and the git transport need of a request, for the asyncio engine """
+	def __init__(self, server, command, path, request_version, headers, client_address):
+		self.server = server
+		self.command = command
+		self.path = path
+		self.request_version = request_version
+		self.headers = headers
+		self.client_address = client_address
+		# form posts to the pages, read before rendering them
+		self.rfile = io.BytesIO()
+		# set from the GITRequestHandler class, or from the GITRepo in multi-repository mode
+		self.repo_name = None
+		self.repo_path = None
+		self.repo_vfolder = None
+		self.backend_prefix = ""
+		self.pages = None
+		self.pack_cache = None
+		# the body must be read to the end before the connection can take another request
+		self.body_done = not ('Content-Length' in headers or 'Transfer-Encoding' in headers)
+		self.close_connection = request_version != "HTTP/1.1" or headers.get('Connection', "").lower() == "close"
+		self.route = "other"
+		self.status = None
+
+
+class GITAsyncServer(object):
+	"""HTTP server on an asyncio event loop, a replacement for GITHTTPServer.
+	Connections, request bodies and the git transport processes live on the loop, so idle
+	and slow clients cost no thread. Pages are rendered on a pool of `workers` threads"""
+	# seconds to wait for the headers of the first request, and between requests of a connection
+	header_timeout = 30
+	keep_alive_timeout = 60
+	max_header_size = 64 << 10
+	# bigger form posts to the pages are refused
+	max_form_size = 16 << 20
+	# bytes queued for a client before waiting for it to read them
+	write_buffer = 256 << 10
+
+	def __init__(self, server_address, handler, workers=1):
+		self.handler = handler
+		self.workers = workers
+		self.socket = socket.create_server(server_address)
+		self.server_address = self.socket.getsockname()
+		self.server_name = socket.getfqdn(self.server_address[0])
+		self.server_port = self.server_address[1]
+		self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="git-serve")
+		self.loop = None
+
+	def serve_forever(self):
+		asyncio.run(self._serve_forever())
+
+	async def _serve_forever(self):
+		self.loop = asyncio.get_running_loop()
+		server = await asyncio.start_server(self._connection, sock=self.socket, limit=self.max_header_size)
+		async with server:
+			await server.serve_forever()
+
+	def server_close(self):
+		self.socket.close()
+		self.executor.shutdown(wait=False)
+
+	def _run(self, func, *args):
+		"""run blocking `func` on the worker threads"""
+		return self.loop.run_in_executor(self.executor, func, *args)
+
+	async def _connection(self, reader, writer):
+		writer.transport.set_write_buffer_limits(high=self.write_buffer)
+		peer = writer.get_extra_info("peername") or ("", 0)
+		try:
+			timeout = self.header_timeout
+			while True:
+				request = await asyncio.wait_for(self._read_request(reader, peer), timeout)
+				if request is None:
+					break
+				await self._handle(request, reader, writer)
+				if request.close_connection or not request.body_done:
+					break
+				timeout = self.keep_alive_timeout
+		except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+			pass
+		except Exception:
+			logger.exception("error serving connection")
+		finally:
+			writer.close()
+
+	async def _read_request(self, reader, peer):
+		"""the next request of a connection, None when it's closed"""
+		line = await reader.readline()
+		while line in (b"\r\n", b"\n"):
+			line = await reader.readline()
+		if not line:
+			return None
+		parts = line.decode("latin-1").split()
+		if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+			raise ValueError("bad request line")
+		head = b""
+		while True:
+			line = await reader.readline()
+			if not line:
+				return None
+			head += line
+			if line in (b"\r\n", b"\n"):
+				break
+			if len(head) > self.max_header_size:
+				raise ValueError("headers too big")
+		return GITAsyncRequest(self, parts[0], parts[1], parts[2], parse_headers(io.BytesIO(head)), peer)
+
+	async def _handle(self, request, reader, writer):
+		start = time.perf_counter()
+		metrics.inc("git_serve_requests_in_flight", (), 1)
+		try:
+			if not request.command in ("GET", "POST"):
+				request.close_connection = True
+				await self._respond(request, writer, 501, [('Content-Length', 0)])
+				return
+			if request.headers.get('Expect', "").lower() == "100-continue" and not request.body_done:
+				writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+			await self._dispatch(request, reader, writer)
+		finally:
+			metrics.inc("git_serve_requests_in_flight", (), -1)
+			metrics.inc("git_serve_requests_total", (("route", request.route), ("code", str(request.status))))
+			metrics.observe("git_serve_request_duration_seconds", (("route", request.route),), time.perf_counter() - start)
+
+	async def _dispatch(self, request, reader, writer):
+		"""like GITRequestHandler.do_GET"""
+		handler = self.handler
+		if request.command == "GET" and request.path == "/metrics":
+			request.route = "metrics"
+			body = metrics.render().encode("utf-8")
+			await self._respond(request, writer, 200, [('Content-type', "text/plain; version=0.0.4"), ('Content-Length', len(body))], body)
+			return
+		if handler.repos is None:
+			request.repo_name = handler.repo_name
+			request.repo_path = handler.repo_path
+			request.repo_vfolder = handler.repo_vfolder
+			request.pages = handler.pages
+			request.pack_cache = handler.pack_cache
+			await self._serve(request, reader, writer)
+			return
+
+		path = request.path.partition("?")[0]
+		name = await self._run(handler.repos.find, path)
+		if name is None:
+			if request.command == "GET" and path == "/":
+				request.route = "repos"
+				body = (await self._run(handler.repos.index)).encode("utf-8")
+				await self._respond(request, writer, 200, [('Content-type', "text/html"), ('Content-Length', len(body))], body)
+			else:
+				await self._not_found(request, writer)
+			return
+		if path == f"/{name}":
+			await self._respond(request, writer, 301, [('Location', f"/{name}/"), ('Content-Length', 0)])
+			return
+		repo = await self._run(handler.repos.acquire, name)
+		try:
+			request.repo_name = repo.name
+			request.repo_path = repo.path
+			request.repo_vfolder = repo.vfolder
+			request.backend_prefix = repo.vfolder
+			request.pages = repo.pages
+			request.pack_cache = repo.pack_cache
+			await self._serve(request, reader, writer)
+		finally:
+			handler.repos.release(repo)
+
+	async def _serve(self, request, reader, writer):
+		"""git transport, pages, then git-http-backend, like GITRequestHandler._serve"""
+		path, _, query = request.path.partition("?")
+		in_repo = path.startswith(request.repo_vfolder + "/")
+		if in_repo:
+			service = path[len(request.repo_vfolder):]
+			if request.command == "GET" and service == "/info/refs" and parse_qs(query).get('service') == ["git-upload-pack"]:
+				request.route = "info_refs"
+				await self._upload_pack(request, reader, writer, advertise=True)
+				return
+			if request.command == "POST" and service == "/git-upload-pack":
+				request.route = "upload_pack"
+				await self._upload_pack(request, reader, writer, advertise=False)
+				return
+
+		ctype = request.headers.get('Content-Type', "").split(";")[0].strip().lower()
+		if request.command == "POST" and ctype in ("multipart/form-data", "application/x-www-form-urlencoded"):
+			form = b""
+			async for data in self._body(request, reader):
+				form += data
+				if len(form) > self.max_form_size:
+					request.close_connection = True
+					await self._respond(request, writer, 413, [('Content-Length', 0)])
+					return
+			request.rfile = io.BytesIO(form)
+			del request.headers['Content-Length']
+			request.headers['Content-Length'] = str(len(form))
+
+		route, r, headers, encodings = await self._run(render_page, request.pages, request)
+		if not r is None:
+			request.route = route
+			code, headers, body = page_response(r, headers, encodings, request.pages.min_compress_size)
+			with metrics.timer("git_serve_step_duration_seconds", (("step", "send"),)):
+				await self._respond(request, writer, code, headers, body)
+			return
+		if in_repo:
+			await self._cgi(request, reader, writer)
+			return
+		await self._not_found(request, writer)
+
+	async def _not_found(self, request, writer):
+		body = b"Not found\n"
+		await self._respond(request, writer, 404, [('Content-type', "text/plain"), ('Content-Length', len(body))], body)
+
+	async def _respond(self, request, writer, code, headers, body=b""):
+		"""send a response. `body` is bytes, an iterator of chunks advanced on the worker threads,
+		or an async iterator. bodies without a Content-Length are sent chunked.
+		waits for the client to read what's queued before producing more"""
+		request.status = code
+		streamed = not isinstance(body, bytes)
+		chunked = streamed and not 'content-length' in [k.lower() for k, v in headers]
+		if chunked and request.request_version != "HTTP/1.1":
+			# the end of the connection marks the end of the body
+			request.close_connection = True
+			chunked = False
+		try:
+			reason = HTTPStatus(code).phrase
+		except ValueError:
+			reason = ""
+		head = [f"HTTP/1.1 {code} {reason}", "Server: git-serve", "Date: " + formatdate(usegmt=True)]
+		if request.close_connection:
+			head.append("Connection: close")
+		if chunked:
+			head.append("Transfer-Encoding: chunked")
+		head += [f"{k}: {v}" for k, v in headers]
+		writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1", "replace"))
+		if not streamed:
+			writer.write(body)
+			await writer.drain()
+			return
+
+		is_async = hasattr(body, "__anext__")
+		try:
+			while True:
+				if is_async:
+					try:
+						chunk = await body.__anext__()
+					except StopAsyncIteration:
+						break
+				else:
+					chunk = await self._run(next, body, None)
+					if chunk is None:
+						break
+				if isinstance(chunk, str):
+					chunk = chunk.encode("utf-8")
+				if not chunk:
+					continue
+				if chunked:
+					writer.write(b"%x\r\n" % len(chunk))
+					writer.write(chunk)
+					writer.write(b"\r\n")
+				else:
+					writer.write(chunk)
+				await writer.drain()
+			if chunked:
+				writer.write(b"0\r\n\r\n")
+			await writer.drain()
+		except ConnectionError:
+			request.close_connection = True
+		except Exception:
+			# headers are gone already, all we can do is to cut the response short
+			logger.exception("error streaming response")
+			request.close_connection = True
+		finally:
+			if is_async:
+				await body.aclose()
+			elif hasattr(body, "close"):
+				await self._run(body.close)
+
+	async def _body(self, request, reader, chunk_size=1 << 16):
+		"""yields the request body in chunks of bytes, as it arrives"""
+		if request.headers.get('Transfer-Encoding', "").lower() == "chunked":
+			while True:
+				size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+				if size == 0:
+					# skip trailers
+					while (await reader.readline()).strip() != b"":
+						pass
+					break
+				while size > 0:
+					data = await reader.read(min(size, chunk_size))
+					if not data:
+						return
+					size -= len(data)
+					yield data
+				await reader.readline()
+		else:
+			remaining = int(request.headers.get('Content-Length') or 0)
+			while remaining > 0:
+				data = await reader.read(min(remaining, chunk_size))
+				if not data:
+					return
+				remaining -= len(data)
+				yield data
+		request.body_done = True
+
+	async def _body_data(self, request, reader, chunk_size=1 << 16):
+		"""yields the request body in chunks of bytes, decompressing it if it's gzipped"""
+		if not request.headers.get('Content-Encoding', "").lower() in ("gzip", "x-gzip"):
+			async for data in self._body(request, reader, chunk_size):
+				yield data
+			return
+		decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		async for data in self._body(request, reader, chunk_size):
+			data = decoder.decompress(data, chunk_size)
+			while data:
+				yield data
+				data = decoder.decompress(decoder.unconsumed_tail, chunk_size)
+		yield decoder.flush()
+
+	async def _feed(self, stdin, head, chunks):
+		"""copy `head` and the `chunks` of the request body to `stdin`"""
+		try:
+			if head:
+				stdin.write(head)
+				await stdin.drain()
+			async for data in chunks:
+				stdin.write(data)
+				await stdin.drain()
+		except (OSError, ValueError, zlib.error):
+			logger.exception("error reading request body")
+		finally:
+			stdin.close()
+
+	async def _finish(self, proc, feeder):
+		"""stop git process `proc` and the task feeding it"""
+		if proc.returncode is None:
+			try:
+				proc.kill()
+			except ProcessLookupError:
+				pass
+		await proc.wait()
+		if not feeder is None:
+			if not feeder.done():
+				feeder.cancel()
+			await asyncio.gather(feeder, return_exceptions=True)
+
+	async def _upload_pack(self, request, reader, writer, advertise):
+		"""like GITRequestHandler._upload_pack, with git running on the loop"""
+		env = dict(os.environ)
+		protocol = request.headers.get('Git-Protocol') or ""
+		if protocol:
+			env['GIT_PROTOCOL'] = protocol
+		pack_cache = request.pack_cache
+
+		body = None
+		head = b""
+		key = None
+		if not advertise:
+			body = self._body_data(request, reader)
+			if not pack_cache is None:
+				async for chunk in body:
+					head += chunk
+					if len(head) > GITRequestHandler.max_pack_request:
+						break
+				else:
+					key = await self._run(pack_cache.key, head, protocol)
+
+		headers = [
+			('Content-Type', 'application/x-git-upload-pack-{0}'.format("advertisement" if advertise else "result")),
+			('Cache-Control', 'no-cache'),
+		]
+		tee = None
+		if not key is None:
+			# wait on the loop for a build of the same pack, the worker threads render the pages
+			built = self.loop.create_future()
+			if pack_cache.on_built(key, partial(self.loop.call_soon_threadsafe, built.set_result, None)):
+				await asyncio.wait([built], timeout=600)
+			f = await self._run(pack_cache.open, key, 0)
+			if not f is None:
+				await self._respond(request, writer, 200, headers, count_pack_bytes(file_chunks(f), "true"))
+				return
+			tee = pack_cache.start(key)
+
+		out = None
+		if not tee is None:
+			# keep a copy of the response for the next identical request
+			out = os.fdopen(tee[0], "wb")
+		ok = False
+		try:
+			cmd = ['git', 'upload-pack', '--stateless-rpc']
+			if advertise:
+				cmd.append('--advertise-refs')
+			cmd.append(request.repo_path)
+			start = time.perf_counter()
+			proc = await asyncio.create_subprocess_exec(*cmd, stdin=DEVNULL if advertise else PIPE, stdout=PIPE, env=env)
+			feeder = None
+			if not advertise:
+				feeder = asyncio.ensure_future(self._feed(proc.stdin, head, body))
+
+			async def output():
+				nonlocal ok
+				if advertise and not "version=2" in protocol:
+					yield pkt_line(b"# service=git-upload-pack\n") + b"0000"
+				size = 0
+				try:
+					while True:
+						chunk = await proc.stdout.read(1 << 16)
+						if not chunk:
+							break
+						if not out is None:
+							await self._run(out.write, chunk)
+						size += len(chunk)
+						yield chunk
+					ok = await proc.wait() == 0
+				finally:
+					metrics.inc("git_serve_upload_pack_bytes_total", (("cached", "false"),), size)
+
+			try:
+				await self._respond(request, writer, 200, headers, output())
+			finally:
+				await self._finish(proc, feeder)
+				metrics.observe("git_serve_git_duration_seconds", (("command", "upload-pack"),), time.perf_counter() - start)
+		finally:
+			# also when the client left before the response started
+			if not out is None:
+				def done():
+					out.close()
+					pack_cache.finish(key, tee[1], ok)
+				# not awaited, it must run even if this task is cancelled
+				self._run(done)
+
+	async def _cgi(self, request, reader, writer):
+		"""run git-http-backend for the rest of the git protocol"""
+		request.route = "cgi"
+		path, _, query = request.path.partition("?")
+		env = dict(os.environ)
+		env.update({
+			'GATEWAY_INTERFACE': "CGI/1.1",
+			'SERVER_SOFTWARE': "git-serve",
+			'SERVER_NAME': self.server_name,
+			'SERVER_PORT': str(self.server_port),
+			'SERVER_PROTOCOL': request.request_version,
+			'REQUEST_METHOD': request.command,
+			'SCRIPT_NAME': request.repo_vfolder,
+			'PATH_INFO': request.backend_prefix + path[len(request.repo_vfolder):],
+			'QUERY_STRING': query,
+			'REMOTE_ADDR': request.client_address[0],
+			'CONTENT_TYPE': request.headers.get('Content-Type', ""),
+		})
+		if 'Content-Length' in request.headers:
+			env['CONTENT_LENGTH'] = request.headers['Content-Length']
+		for k, v in request.headers.items():
+			k = k.upper().replace("-", "_")
+			if not k in ("PROXY", "CONTENT_TYPE", "CONTENT_LENGTH"):
+				env["HTTP_" + k] = v
+
+		proc = await asyncio.create_subprocess_exec(GIT_HTTP_BACKEND, stdin=PIPE, stdout=PIPE, env=env)
+		feeder = asyncio.ensure_future(self._feed(proc.stdin, b"", self._body(request, reader)))
+		try:
+			code = 200
+			headers = []
+			while True:
+				line = (await proc.stdout.readline()).decode("latin-1").strip()
+				if line == "":
+					break
+				k, _, v = line.partition(":")
+				if k.strip().lower() == "status":
+					code = int(v.split()[0])
+				else:
+					headers.append((k.strip(), v.strip()))
+
+			async def output():
+				while True:
+					chunk = await proc.stdout.read(1 << 16)
+					if not chunk:
+						break
+					yield chunk
+
+			await self._respond(request, writer, code, headers, output())
+		finally:
+			await self._finish(proc, feeder)
+
+
+def default_cache_dir():
+	"""where to keep caches that survive restarts"""
+	base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(base, "git-serve")
 
 
 handler = None
 def start_serve(git_repo_path, port=8001, options={}):
+	"""serve the repository at `git_repo_path`, or all the repositories below it if options['multi'] is set"""
 	global handler
 	os.environ['GIT_PROJECT_ROOT'] = git_repo_path
 	os.environ['GIT_HTTP_EXPORT_ALL'] = "1"
 	os.environ['GIT_PAGER'] = "cat"
 	
-	server = HTTPServer
+	print("[{0}] markdown  [{1}] pygments".format(" " if markdown is None else "#", " " if highlight is None else "#"))
+
+	server_class = GITAsyncServer if options.get('engine') == "asyncio" else GITHTTPServer
+	server = partial(server_class, workers=options.get('workers') or os.cpu_count() or 1)
+	GITServePages.archive_builds = threading.BoundedSemaphore(options.get('archive_builds', 2))
 	handler = GITRequestHandler
 	server_address = ("", port)
 	
 	repo_name = os.path.basename(git_repo_path)
 	
-	handler.repo_path = git_repo_path
-	handler.repo_name = repo_name
-	handler.repo_vfolder = f"/{repo_name}"
-	handler.cgi_directories = [f"/{repo_name}"]
-	handler.pages = GITServePages(options)
+	if options.get('multi'):
+		handler.repos = GITRepos(git_repo_path, options, options.get('idle_timeout', 600))
+	else:
+		handler.repo_path = git_repo_path
+		handler.repo_name = repo_name
+		handler.repo_vfolder = f"/{repo_name}"
+		handler.cgi_directories = [f"/{repo_name}"]
+		handler.pages = GITServePages(options)
+		if options.get('pack_cache_size'):
+			handler.pack_cache = PackCache(os.path.join(handler.pages.repo_cache_dir, "packs"), options['pack_cache_size'])
 		
 	httpd = server(server_address, handler)
-	print(f"""
+	if options.get('multi'):
+		print(f"""
+	Serving the git repos in '{git_repo_path}'
+	
+	Web interface at http://{httpd.server_name}:{httpd.server_port}
+	git clone http://{httpd.server_name}:{httpd.server_port}/<repo>/
+		""")
+	else:
+		print(f"""
 	Serving git repo '{repo_name}'
 	
 	Web interface at http://{httpd.server_name}:{httpd.server_port}
 	git clone http://{httpd.server_name}:{httpd.server_port}/{repo_name}/
-		
+		""")
+	print(f"""	Serving with {httpd.workers} worker threads{" and asyncio" if options.get('engine') == "asyncio" else ""}.
 	CTRL+C to stop.
 	""")
 	try:
 		httpd.serve_forever()	
 	except KeyboardInterrupt:
 		pass
+	httpd.server_close()
 
 def cleanup():
 	global handler
-	import shutil
 	if not handler is None:
 		print("cleaning up...")
-		shutil.rmtree(handler.pages.tmpdir)
+		if not handler.repos is None:
+			handler.repos.evict(0)
+		else:
+			handler.pages.close()
+	GIT.close()
 
 atexit.register(cleanup)
 
@@ -813,19 +4254,82 @@ if __name__=="__main__":
 	parser.add_argument('--no-gravatar', dest='nogravatar', action='store_true',
 		               default=False,
 		               help='disable commit avatars')
+	parser.add_argument('--workers', dest='workers', type=int, default=None,
+		               help='max number of requests served in parallel (default: number of cpus)')
+	parser.add_argument('--engine', dest='engine', choices=("threads", "asyncio"), default="threads",
+		               help='threads: a thread per request. asyncio: connections and clones on an event loop, '
+		                    'pages rendered by the worker threads (default: threads)')
+	parser.add_argument('--cache-size', dest='cache_size', type=int, default=64,
+		               help='memory budget for cached pages, in MB (default: 64)')
+	parser.add_argument('--disk-cache-size', dest='disk_cache_size', type=int, default=0,
+		               help='size of the on-disk tier for pages evicted from memory, in MB (default: 0, disabled)')
+	parser.add_argument('--cache-dir', dest='cache_dir', default=None,
+		               help='directory for caches kept across restarts (default: ~/.cache/git-serve)')
+	parser.add_argument('--highlight-cache-size', dest='highlight_cache_size', type=int, default=256,
+		               help='size of the syntax highlight cache, in MB (default: 256, 0 disables it)')
+	parser.add_argument('--max-highlight-size', dest='max_highlight_size', type=int, default=512,
+		               help="files bigger than this are not highlighted, in KB (default: 512)")
+	parser.add_argument('--max-view-size', dest='max_view_size', type=int, default=16,
+		               help="files bigger than this are not shown, in MB (default: 16)")
+	parser.add_argument('--pack-cache-size', dest='pack_cache_size', type=int, default=1024,
+		               help="size of the cache of packs sent to clones and fetches, in MB (default: 1024, 0 disables it)")
+	parser.add_argument('--archive-cache-size', dest='archive_cache_size', type=int, default=512,
+		               help="size of the cache of tar.gz and zip archives, in MB (default: 512, 0 disables it)")
+	parser.add_argument('--archive-builds', dest='archive_builds', type=int, default=2,
+		               help="archives built at the same time, more requests get a 503 (default: 2)")
+	parser.add_argument('--blame-cache-size', dest='blame_cache_size', type=int, default=256,
+		               help="size of the cache of blames, in MB (default: 256, 0 disables it)")
+	parser.add_argument('--min-compress-size', dest='min_compress_size', type=int, default=1024,
+		               help="pages smaller than this are not compressed, in bytes (default: 1024)")
+	parser.add_argument('--page-size', dest='page_size', type=int, default=40,
+		               help="commits per history page (default: 40)")
+	parser.add_argument('--max-diff-file-lines', dest='max_diff_file_lines', type=int, default=1000,
+		               help="diffs of files changing more lines are loaded on demand (default: 1000)")
+	parser.add_argument('--max-diff-lines', dest='max_diff_lines', type=int, default=10000,
+		               help="changed lines shown at once in a diff or commit page (default: 10000)")
+	parser.add_argument('--root', dest='root', default=None,
+		               help="serve all the git repos found below this directory, instead of the current one")
+	parser.add_argument('--idle-timeout', dest='idle_timeout', type=int, default=600,
+		               help="with --root, drop the caches of a repo after this many seconds without requests (default: 600)")
 
 	args = parser.parse_args()
 	
 	port = int(args.port)
 	
-	try:
-		repo_path = GIT.rev_parse("--show-toplevel")
-	except CalledProcessError as e:
-		print(e.output)
-		sys.exit(e.returncode)
-	repo_path = repo_path.replace("/",os.path.sep).strip()
+	if not args.root is None:
+		repo_path = os.path.abspath(args.root)
+		if not os.path.isdir(repo_path):
+			print(f"{args.root} is not a directory")
+			sys.exit(1)
+	else:
+		try:
+			repo_path = GIT.rev_parse("--show-toplevel")
+		except CalledProcessError as e:
+			print(e.output)
+			sys.exit(e.returncode)
+		repo_path = repo_path.replace("/",os.path.sep).strip()
 
-	start_serve(repo_path, port, {'nogravatar':args.nogravatar})
+	start_serve(repo_path, port, {
+		'nogravatar':args.nogravatar,
+		'workers':args.workers,
+		'engine':args.engine,
+		'cache_size':args.cache_size << 20,
+		'disk_cache_size':args.disk_cache_size << 20,
+		'cache_dir':args.cache_dir,
+		'highlight_cache_size':args.highlight_cache_size << 20,
+		'max_highlight_size':args.max_highlight_size << 10,
+		'max_view_size':args.max_view_size << 20,
+		'page_size':args.page_size,
+		'max_diff_file_lines':args.max_diff_file_lines,
+		'max_diff_lines':args.max_diff_lines,
+		'pack_cache_size':args.pack_cache_size << 20,
+		'archive_cache_size':args.archive_cache_size << 20,
+		'archive_builds':args.archive_builds,
+		'blame_cache_size':args.blame_cache_size << 20,
+		'min_compress_size':args.min_compress_size,
+		'multi':not args.root is None,
+		'idle_timeout':args.idle_timeout,
+	})
 		
 	
 	